@@ -4,6 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
+import time
 from . import toolchanger
 
 class Tool:
@@ -11,22 +12,24 @@ class Tool:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.params = config.get_prefix_options('params_')
-        self.gcode_macro = self.printer.load_object(config, 'gcode_macro')
 
         self.name = config.get_name()
         toolchanger_name = config.get('toolchanger', 'toolchanger')
         self.main_toolchanger = self.printer.load_object(config, 'toolchanger')
         self.toolchanger = self.printer.load_object(config, toolchanger_name)
-        self.pickup_gcode = self.gcode_macro.load_template(
+        start_time = time.perf_counter()
+        self.pickup_gcode = self.toolchanger.templates.load_template(
             config, 'pickup_gcode', self._config_get(config, 'pickup_gcode', ''))
-        self.dropoff_gcode = self.gcode_macro.load_template(
+        self.dropoff_gcode = self.toolchanger.templates.load_template(
             config, 'dropoff_gcode', self._config_get(config, 'dropoff_gcode', ''))
-        self.before_change_gcode = self.gcode_macro.load_template(
+        self.before_change_gcode = self.toolchanger.templates.load_template(
             config, 'before_change_gcode', self._config_get(config, 'before_change_gcode', ''))
-        self.after_change_gcode = self.gcode_macro.load_template(
+        self.after_change_gcode = self.toolchanger.templates.load_template(
             config, 'after_change_gcode', self._config_get(config, 'after_change_gcode', ''))
-        self.recover_gcode = self.gcode_macro.load_template(
+        self.recover_gcode = self.toolchanger.templates.load_template(
             config, 'recover_gcode', self._config_get(config, 'recover_gcode', ''))
+        self.prestage_gcode = self.toolchanger.templates.load_template(
+            config, 'prestage_gcode', self._config_get(config, 'prestage_gcode', ''))
         self.gcode_x_offset = self._config_getfloat(
             config, 'gcode_x_offset', 0.0)
         self.gcode_y_offset = self._config_getfloat(
@@ -35,6 +38,9 @@ class Tool:
             config, 'gcode_z_offset', 0.0)
         self.params = {**self.toolchanger.params, **toolchanger.get_params_dict(config)}
         self.original_params = {}
+        # Incremented on parameter, tool number and detection changes.
+        self.status_version = 0
+        self.status_cache = (None, None)
         self.extruder_name = self._config_get(config, 'extruder', None)
         self.heater_name = self._config_get(config, 'heater', None)
         detect_pin_name = config.get('detection_pin', None)
@@ -42,6 +48,8 @@ class Tool:
         if detect_pin_name:
             self.printer.load_object(config, 'buttons').register_buttons([detect_pin_name], self._handle_detect)
             self.detect_state = toolchanger.DETECT_PRESENT
+        self.detect_timeout = self._config_getfloat(
+            config, 'tool_detect_timeout', None)
         self.extruder_stepper_name = self._config_get(config, 'extruder_stepper', None)
         self.extruder = None
         self.heater = None
@@ -57,7 +65,28 @@ class Tool:
             self.toolchanger.add_probe(self.probe)
         self.t_command_restore_axis = self._config_get(
             config, 't_command_restore_axis', 'XYZ')
+        self.preheat_time = self._config_getfloat(config, 'preheat_time', 30.)
+        self.prestage_time = self._config_getfloat(config, 'prestage_time', 60.)
+        self.standby_temperature = self._config_getfloat(
+            config, 'standby_temperature', None)
+        self.standby_delay = self._config_getfloat(config, 'standby_delay', 60.)
+        self.pickup_retries = self._config_getint(config, 'pickup_retries', 0)
+        # Option -> value, applied when selected.
+        self.motion_profile = {}
+        for option in toolchanger.MOTION_PROFILE_OPTIONS:
+            if option.startswith('shaper_type'):
+                value = self._config_get(config, option, None)
+                # Same as SET_INPUT_SHAPER
+                value = value.lower() if value else value
+            else:
+                value = self._config_getfloat(config, option, None)
+            if value is not None:
+                self.motion_profile[option] = value
+        self.pickup_retry_path_speed = self._config_getfloat(
+            config, 'pickup_retry_path_speed', None)
+        self.last_active_temperature = None
         self.tool_number = config.getint('tool_number', -1, minval=0)
+        self.main_toolchanger.register_tool(self)
         if self.tool_number >= 0:
             self.assign_tool(self.tool_number)
 
@@ -65,6 +94,7 @@ class Tool:
         gcode.register_mux_command("ASSIGN_TOOL", "TOOL", self.name,
                                    self.cmd_ASSIGN_TOOL,
                                    desc=self.cmd_ASSIGN_TOOL_help)
+        self.main_toolchanger.note_config_time(start_time)
 
         self.printer.register_event_handler("klippy:connect",
                                     self._handle_connect)
@@ -74,16 +104,26 @@ class Tool:
             self.original_params[name] = self.params[name]
         self.params[name] = value
         self._apply_param(name, value)
+        self.status_version += 1
 
     def reset_parameter(self, name):
         if name in self.original_params:
             value = self.original_params[name]
             self.params[name] = value
             self._apply_param(name, value)
+            self.status_version += 1
 
     def save_parameter(self, name):
-        configfile = self.printer.lookup_object('configfile')
-        configfile.set(self.name, name, self.params[name])
+        store = self.toolchanger.parameter_store
+        if store.is_enabled():
+            # The saved value is the new value to reset to.
+            self.original_params.pop(name, None)
+        store.save(self, name, self.params[name])
+
+    def load_parameter(self, name, value):
+        self.params[name] = value
+        self._apply_param(name, value)
+        self.status_version += 1
 
     def __str__(self):
         return self.name
@@ -95,6 +135,11 @@ class Tool:
                 self.gcode_y_offset = float(value)
         elif name == 'gcode_z_offset':
                 self.gcode_z_offset = float(value)
+        else:
+            return
+        self.main_toolchanger.note_tool_offset_change(self)
+        if self.toolchanger is not self.main_toolchanger:
+            self.toolchanger.note_tool_offset_change(self)
 
     def _handle_connect(self):
         self.extruder = self.printer.lookup_object(
@@ -106,16 +151,35 @@ class Tool:
         elif self.extruder:
             self.heater = self.extruder.get_heater()
             self.heater_name = self.extruder_name
+        self.status_version += 1
+        self.main_toolchanger.register_tool(self)
         if self.fan_name:
             self.fan = self.printer.lookup_object(self.fan_name,
                       self.printer.lookup_object("fan_generic " + self.fan_name, None))
+        targets = {toolchanger.MOTION_PROFILE_OPTIONS[option][0]
+                   for option in self.motion_profile}
+        if 'extruder' in targets and self.get_pressure_advance_stepper() is None:
+            raise self.printer.config_error(
+                "%s: pressure_advance needs an extruder or extruder_stepper"
+                % (self.name,))
+        if ('input_shaper' in targets
+                and self.printer.lookup_object('input_shaper', None) is None):
+            raise self.printer.config_error(
+                "%s: shaper settings need [input_shaper]" % (self.name,))
 
     def _handle_detect(self, eventtime, is_triggered):
         self.detect_state = toolchanger.DETECT_ABSENT if is_triggered else toolchanger.DETECT_PRESENT
-        self.toolchanger.note_detect_change(self, eventtime)
+        self.status_version += 1
+        # Tools are registered with the main toolchanger only.
+        self.main_toolchanger.note_detect_change(self, eventtime)
 
     def get_status(self, eventtime):
-        return {**self.params,
+        active = self.main_toolchanger.get_selected_tool() == self
+        usage = self.toolchanger.usage.get_counters(self)
+        key = (self.status_version, active, usage)
+        if self.status_cache[0] == key:
+            return self.status_cache[1]
+        status = {**self.params,
                 'name': self.name,
                 'toolchanger': self.toolchanger.name,
                 'detect_state': self.detect_state,
@@ -124,11 +188,15 @@ class Tool:
                 'heater': self.heater_name,
                 'extruder_stepper': self.extruder_stepper_name,
                 'fan': self.fan_name,
-                'active': self.main_toolchanger.get_selected_tool() == self,
+                'active': active,
+                'standby_state': self.main_toolchanger.standby.get_state(self),
+                'usage': usage,
                 'gcode_x_offset': self.gcode_x_offset if self.gcode_x_offset else 0.0,
                 'gcode_y_offset': self.gcode_y_offset if self.gcode_y_offset else 0.0,
                 'gcode_z_offset': self.gcode_z_offset if self.gcode_z_offset else 0.0,
                 }
+        self.status_cache = (key, status)
+        return status
 
     def get_offset(self):
         return [
@@ -144,6 +212,7 @@ class Tool:
     def assign_tool(self, number, replace = False):
         prev_number = self.tool_number
         self.tool_number = number
+        self.status_version += 1
         self.main_toolchanger.assign_tool(self, number, prev_number, replace)
         self.register_t_gcode(number)
 
@@ -162,33 +231,33 @@ class Tool:
                 gcmd, tc.lookup_tool(number), axis)
             gcode.register_command(name, func, desc=desc)
 
+    def get_pressure_advance_stepper(self):
+        obj = self.extruder_stepper or self.extruder
+        return getattr(obj, 'extruder_stepper', None)
+
     def activate(self):
-        toolhead = self.printer.lookup_object('toolhead')
-        gcode = self.printer.lookup_object('gcode')
-        hotend_extruder = toolhead.get_extruder().name
-        if self.extruder_name and self.extruder_name != hotend_extruder:
-            gcode.run_script_from_command(
-                "ACTIVATE_EXTRUDER EXTRUDER='%s'" % (self.extruder_name,))
-        hotend_extruder = toolhead.get_extruder().name
-        if self.extruder_stepper and hotend_extruder:
-                gcode.run_script_from_command(
-                    "SYNC_EXTRUDER_MOTION EXTRUDER='%s' MOTION_QUEUE=" % (self.extruder_stepper_name, ))
-                gcode.run_script_from_command(
-                    "SYNC_EXTRUDER_MOTION EXTRUDER='%s' MOTION_QUEUE='%s'" % (self.extruder_stepper_name, hotend_extruder, ))
+        self.main_toolchanger.extruder_switcher.activate(self)
+        self.main_toolchanger.motion_switcher.activate(self)
+        self.toolchanger.usage.activate(self)
         if self.fan:
             self.toolchanger.fan_switcher.activate_fan(self.fan)
     def deactivate(self):
-        if self.extruder_stepper:
-            toolhead = self.printer.lookup_object('toolhead')
-            gcode = self.printer.lookup_object('gcode')
-            hotend_extruder = toolhead.get_extruder().name
-            gcode.run_script_from_command(
-                "SYNC_EXTRUDER_MOTION EXTRUDER='%s' MOTION_QUEUE=" % (self.extruder_stepper_name,))
+        if self.heater:
+            curtime = self.printer.get_reactor().monotonic()
+            target = self.heater.get_temp(curtime)[1]
+            if target > 0.:
+                self.last_active_temperature = target
+        self.main_toolchanger.extruder_switcher.deactivate(self)
+        self.main_toolchanger.motion_switcher.deactivate(self)
+        self.toolchanger.usage.deactivate(self)
 
     def _config_get(self, config, name, default_value):
         return config.get(name, self.toolchanger.config.get(name, default_value))
     def _config_getfloat(self, config, name, default_value):
         return config.getfloat(name, self.toolchanger.config.getfloat(name, default_value))
+    def _config_getint(self, config, name, default_value):
+        return config.getint(name, self.toolchanger.config.getint(
+            name, default_value, minval=0), minval=0)
     def _config_getboolean(self, config, name, default_value):
         return config.getboolean(name, self.toolchanger.config.getboolean(name, default_value))
 
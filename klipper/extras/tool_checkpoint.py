@@ -0,0 +1,152 @@
+# Toolchanger state checkpoint, to resume after a restart
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import json, logging, os, threading
+
+# Checkpoint is a JSON object:
+#   toolchanger  - toolchanger name
+#   status       - toolchanger status
+#   tool         - active tool name, or null
+#   change_id    - id of the last started tool change
+#   position     - gcode position saved by the last tool change, or null
+#   restore_axis - restore axis of the last tool change
+
+class ToolchangerCheckpoint:
+    """Keeps the toolchanger state in a small file, replaced atomically on
+    every status change.
+
+    After a restart, the first initialization resumes from the checkpoint
+    without running initialize_gcode, when it was written in ready state
+    and the detection pins and the tool probes agree on the active tool.
+    The file is written by a background thread, the latest state wins."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.toolchanger = toolchanger
+        path = config.get('checkpoint_path', None)
+        self.path = os.path.expanduser(path) if path else None
+        self.last_state = None
+        self.loaded = None  # Checkpoint read at connect, until first use
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = None
+        self.stopping = False
+        self.thread = None
+        if self.path:
+            self.printer.register_event_handler('klippy:connect',
+                                                self._handle_connect)
+            self.printer.register_event_handler('klippy:disconnect',
+                                                self._handle_disconnect)
+
+    def _handle_connect(self):
+        self.loaded = self._read()
+        self.last_state = self.loaded
+        self.thread = threading.Thread(target=self._writer,
+                                       name='toolchanger-checkpoint',
+                                       daemon=True)
+        self.thread.start()
+
+    def _handle_disconnect(self):
+        if self.thread is not None:
+            with self.lock:
+                self.stopping = True
+            self.wake.set()
+            self.thread.join(1.)
+            self.thread = None
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.info("Toolchanger: ignoring checkpoint %s: %s",
+                         self.path, str(e))
+            return None
+        if not isinstance(state, dict):
+            return None
+        return state
+
+    def note_status(self):
+        # The toolchanger moved on, the loaded checkpoint is out of date.
+        self.loaded = None
+        if self.thread is None:
+            return
+        tc = self.toolchanger
+        tool = tc.active_tool
+        position = tc.last_change_gcode_position
+        state = {'toolchanger': tc.name,
+                 'status': tc.status,
+                 'tool': tool.name if tool else None,
+                 'change_id': tc.next_change_id - 1,
+                 'position': list(position) if position else None,
+                 'restore_axis': tc.last_change_restore_axis}
+        if state == self.last_state:
+            return
+        self.last_state = state
+        with self.lock:
+            self.pending = state
+        self.wake.set()
+
+    def _writer(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock:
+                state, self.pending = self.pending, None
+                stopping = self.stopping
+            if state is not None:
+                self._write(state)
+            if stopping:
+                break
+
+    def _write(self, state):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception("Toolchanger: unable to write %s", self.path)
+
+    def take_resumable(self, detected_tool):
+        """Returns (tool,) to resume with, or None to initialize normally.
+
+        Only the first initialization after connect may resume."""
+        state, self.loaded = self.loaded, None
+        tc = self.toolchanger
+        if (state is None or state.get('toolchanger') != tc.name
+                or state.get('status') != 'ready'):
+            return None
+        tool = None
+        if state.get('tool') is not None:
+            tool = self.printer.lookup_object(state['tool'], None)
+            if getattr(tool, 'toolchanger', None) is not tc:
+                return None
+        checked = False
+        if tc.has_detection:
+            if detected_tool is not tool:
+                logging.info("Toolchanger: checkpoint tool %s, detected %s",
+                             tool, detected_tool)
+                return None
+            checked = True
+        probe_endstop = tc.tool_probe_endstop
+        if probe_endstop is not None and tool is not None and tool.probe:
+            if probe_endstop.query_open_probes() != [tool.probe]:
+                logging.info("Toolchanger: checkpoint tool %s does not match"
+                             " the tool probes", tool)
+                return None
+            checked = True
+        if not checked:
+            return None
+        position = state.get('position')
+        tc.last_change_gcode_position = list(position) if position else None
+        tc.last_change_restore_axis = state.get('restore_axis') or ''
+        tc.next_change_id = max(tc.next_change_id,
+                                int(state.get('change_id', 0)) + 1)
+        return (tool,)
@@ -0,0 +1,192 @@
+# Append-only journal of tool changes
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import collections, json, logging, os, queue, threading, time
+
+# Journal records are JSON lines, with short keys:
+#   t    - host wall clock time
+#   pt   - print time at the start of the change or error
+#   end  - print time at the end of the change
+#   from - dropped off tool name, or null
+#   to   - picked up tool name, or null
+#   ph   - phase -> duration in seconds
+#   rp   - restore position, eg {"Z": 10.2}
+#   v    - pickup verification: true, false, "async", or missing
+#   rt   - pickup retries made, or missing
+#   err  - error message, for failed changes and errors outside changes
+
+# Max records waiting for the writer, new records are dropped when full.
+MAX_QUEUED = 1000
+
+class ToolchangeJournal:
+    """Writes a record for every tool change and toolchanger error.
+
+    Records are handed to a background thread, file writes and rotation
+    never block the reactor. A failed write is logged and counted, the
+    file is reopened for the next record."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.toolchanger = toolchanger
+        path = config.get('journal_path', None)
+        self.path = os.path.expanduser(path) if path else None
+        self.max_size = config.getint('journal_max_size', 1024 * 1024,
+                                      minval=1024)
+        self.backups = config.getint('journal_backups', 3, minval=0)
+        self.queue = None
+        self.thread = None
+        self.dropped = 0  # Records not queued, the writer fell behind.
+        self.write_errors = 0  # Failed writes, counted by the writer.
+        if self.path:
+            self.printer.register_event_handler('klippy:ready',
+                                                self._handle_ready)
+            self.printer.register_event_handler('klippy:disconnect',
+                                                self._handle_disconnect)
+
+    def _handle_ready(self):
+        self.queue = queue.Queue(MAX_QUEUED)
+        self.thread = threading.Thread(target=self._writer,
+                                       name='toolchange-journal', daemon=True)
+        self.thread.start()
+
+    def _handle_disconnect(self):
+        if self.thread is not None:
+            self._put(None)
+            self.thread.join(1.)
+            self.thread = None
+
+    def write(self, record):
+        if self.queue is None:
+            return
+        self._put({'t': round(time.time(), 3), **record})
+
+    def _put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_loss_report(self):
+        if not self.dropped and not self.write_errors:
+            return None
+        return 'journal: %d records dropped, %d write errors' % (
+            self.dropped, self.write_errors)
+
+    def _writer(self):
+        f = None
+        failing = False
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                if f is None:
+                    f = open(self.path, 'a')
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+                # Write out everything queued, before flushing.
+                if not self.queue.empty():
+                    continue
+                f.flush()
+                if f.tell() >= self.max_size:
+                    f.close()
+                    f = None
+                    self._rotate()
+                failing = False
+            except Exception:
+                self.write_errors += 1
+                # Log the first error only, until a write succeeds again.
+                if not failing:
+                    logging.exception("Toolchanger: journal write failed")
+                failing = True
+                f = self._close(f)
+        self._close(f)
+
+    def _close(self, f):
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+        return None
+
+    def _rotate(self):
+        if self.backups == 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.path, i + 1))
+        os.replace(self.path, self.path + '.1')
+
+def journal_files(path):
+    """Journal file and its rotated backups, oldest first."""
+    files = []
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        files.append('%s.%d' % (path, i))
+        i += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def read_journal(path):
+    for filename in journal_files(path):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Partially written line
+                    continue
+
+class ToolSummary:
+    def __init__(self):
+        self.attempts = 0
+        self.changes = 0
+        self.failures = 0
+        self.verify_failures = 0
+        self.retries = 0
+        self.errors = 0
+        self.total_time = 0.
+        self.phase_time = collections.defaultdict(float)
+
+    def failure_rate(self):
+        return self.failures / self.attempts if self.attempts else 0.
+
+    def mean_time(self):
+        return self.total_time / self.changes if self.changes else 0.
+
+def summarize(records):
+    """Per picked up tool change counts, failures and mean change times.
+
+    Async pickup verification failures are reported after the change
+    completed, they count as a failure of that change. Other errors
+    outside of changes, like the tool going missing, are counted
+    separately."""
+    tools = collections.defaultdict(ToolSummary)
+    for record in records:
+        summary = tools[record.get('to') or 'none']
+        verify_failed = record.get('v') is False
+        if verify_failed:
+            summary.verify_failures += 1
+        if 'ph' not in record:
+            if verify_failed:
+                summary.failures += 1
+            else:
+                summary.errors += 1
+            continue
+        summary.attempts += 1
+        summary.retries += record.get('rt', 0)
+        if 'err' in record:
+            summary.failures += 1
+            continue
+        summary.changes += 1
+        phases = record['ph']
+        summary.total_time += phases.get('total', 0.)
+        for phase, duration in phases.items():
+            summary.phase_time[phase] += duration
+    return dict(tools)
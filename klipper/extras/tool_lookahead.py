@@ -0,0 +1,486 @@
+# Look ahead in the printed file for upcoming tool changes
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import collections, json, logging, math, mmap, os, re
+
+T_COMMAND_RE = re.compile(r'^T(\d+)$')
+# T<n> and SELECT_TOOL lines, for the file analyzer. Searching for the
+# line ends is much faster than ^ in multiline mode.
+_TOOL_CHANGE = (rb'[ \t]*(?:[Tt](\d+)[ \t]*(?:;|\r?$)'
+                rb'|(?i:SELECT_TOOL)\b([^;\r\n]*))')
+TOOL_CHANGE_LINE_RE = re.compile(rb'\n' + _TOOL_CHANGE, re.MULTILINE)
+FIRST_TOOL_CHANGE_LINE_RE = re.compile(_TOOL_CHANGE, re.MULTILINE)
+SELECT_TOOL_ARG_RE = re.compile(
+    rb'\bT=["\']?(\d+)|\bTOOL=(?:"([^"]*)"|\'([^\']*)\'|(\S+))', re.IGNORECASE)
+# Bytes to scan between reactor pauses.
+ANALYZE_CHUNK_BYTES = 8 * 1024 * 1024
+# Files kept in the analyzer index.
+ANALYZE_INDEX_SIZE = 50
+# Tool changes listed in the analyzer report.
+ANALYZE_REPORT_ORDER = 20
+# Keep a time estimate every this many lines, to interpolate the current time.
+MARK_EVERY_LINES = 100
+# Max bytes to scan per timer tick, to keep the reactor responsive.
+MAX_SCAN_BYTES = 256 * 1024
+
+class ToolChangeEvent:
+    def __init__(self, offset, time, tool, temperature):
+        self.offset = offset
+        self.time = time
+        self.tool = tool
+        self.temperature = temperature
+
+class GcodeToolScanner:
+    """Streams through a gcode file and collects upcoming tool changes.
+
+    Print time is estimated from the move lengths and feedrates, and the
+    measured tool change times. Only the part ahead of the current file
+    position is kept in memory."""
+    def __init__(self, toolchanger, path, max_velocity):
+        self.toolchanger = toolchanger
+        self.path = path
+        self.file = open(path, 'rb')
+        self.max_velocity = max_velocity
+        self.offset = 0
+        self.time = 0.
+        self.lines = 0
+        self.marks = collections.deque([(0, 0.)])
+        self.events = collections.deque()
+        self.eof = False
+        # Motion state
+        self.position = [0., 0., 0.]
+        self.speed = 25.
+        self.absolute = True
+        self.tool_temperatures = {}
+
+    def close(self):
+        self.file.close()
+
+    def time_at(self, file_position):
+        # Drop passed marks, keep the last one below the position.
+        marks = self.marks
+        while len(marks) > 1 and marks[1][0] <= file_position:
+            marks.popleft()
+        while self.events and self.events[0].offset < file_position:
+            self.events.popleft()
+        o0, t0 = marks[0]
+        o1, t1 = marks[1] if len(marks) > 1 else (self.offset, self.time)
+        if o1 <= o0 or file_position <= o0:
+            return t0
+        return t0 + (t1 - t0) * (min(file_position, o1) - o0) / (o1 - o0)
+
+    def scan(self, until_time, until_offset=0, max_bytes=MAX_SCAN_BYTES):
+        start = self.offset
+        while (not self.eof and self.offset - start < max_bytes
+               and (self.time < until_time or self.offset < until_offset)):
+            line = self.file.readline()
+            if not line:
+                self.eof = True
+                self.marks.append((self.offset, self.time))
+                break
+            line_offset = self.offset
+            self.offset += len(line)
+            self._process_line(line_offset, line)
+            self.lines += 1
+            if self.lines % MARK_EVERY_LINES == 0:
+                self.marks.append((self.offset, self.time))
+
+    def _process_line(self, offset, line):
+        cpos = line.find(b';')
+        if cpos >= 0:
+            line = line[:cpos]
+        parts = line.decode('utf-8', 'ignore').split()
+        if not parts:
+            return
+        cmd = parts[0].upper()
+        if cmd == 'G1' or cmd == 'G0':
+            self._process_move(parts)
+        elif cmd == 'G4':
+            for p in parts[1:]:
+                if p[0] in 'Pp':
+                    self.time += _to_float(p[1:]) / 1000.
+                elif p[0] in 'Ss':
+                    self.time += _to_float(p[1:])
+        elif cmd == 'G90':
+            self.absolute = True
+        elif cmd == 'G91':
+            self.absolute = False
+        elif cmd == 'M104' or cmd == 'M109':
+            tool_nr = temp = None
+            for p in parts[1:]:
+                if p[0] in 'Tt':
+                    tool_nr = int(_to_float(p[1:]))
+                elif p[0] in 'Ss':
+                    temp = _to_float(p[1:])
+            if tool_nr is not None and temp:
+                self.tool_temperatures[tool_nr] = temp
+        elif cmd == 'SELECT_TOOL':
+            params = dict(p.split('=', 1) for p in parts[1:] if '=' in p)
+            tool = None
+            if 'TOOL' in params:
+                tool = self.toolchanger.registry.by_name.get(
+                    params['TOOL'].strip('"\''))
+            elif 'T' in params:
+                tool = self.toolchanger.lookup_tool(int(_to_float(params['T'])))
+            self._add_event(offset, tool)
+        else:
+            m = T_COMMAND_RE.match(cmd)
+            if m:
+                self._add_event(
+                    offset, self.toolchanger.lookup_tool(int(m.group(1))))
+
+    def _process_move(self, parts):
+        newpos = list(self.position)
+        for p in parts[1:]:
+            axis = p[0].upper()
+            if axis in 'XYZ':
+                i = 'XYZ'.index(axis)
+                v = _to_float(p[1:])
+                newpos[i] = v if self.absolute else newpos[i] + v
+            elif axis == 'F':
+                speed = _to_float(p[1:]) / 60.
+                if speed > 0.:
+                    self.speed = min(speed, self.max_velocity)
+        dist = math.sqrt((newpos[0] - self.position[0]) ** 2
+                         + (newpos[1] - self.position[1]) ** 2
+                         + (newpos[2] - self.position[2]) ** 2)
+        self.position = newpos
+        self.time += dist / self.speed
+
+    def _add_event(self, offset, tool):
+        if tool is None:
+            return
+        self.events.append(ToolChangeEvent(
+            offset, self.time, tool,
+            self.tool_temperatures.get(tool.tool_number)))
+        # Account for the change itself
+        stats = self.toolchanger.profiler.get_stats().get(tool.name)
+        if stats and 'total' in stats:
+            self.time += stats['total']['p50']
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return 0.
+
+class ToolPreheater:
+    """Heats idle tools ahead of their pickup, based on the printed file.
+
+    Also prestages the next tool, when enabled."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.toolchanger = toolchanger
+        self.reactor = self.printer.get_reactor()
+        self.preheat = config.getboolean('lookahead_preheat', False)
+        self.prestage = config.getboolean('lookahead_prestage', False)
+        self.enabled = self.preheat or self.prestage
+        self.interval = config.getfloat('lookahead_interval', 1.0, above=0.)
+        self.lookahead_time = config.getfloat('lookahead_time', 300.,
+                                              above=0.)
+        # Per tool values, read here to provide the default.
+        config.getfloat('preheat_time', None, minval=0.)
+        config.getfloat('prestage_time', None, minval=0.)
+        self.scanner = None
+        self.preheated = {}  # Tool -> event offset preheated for
+        self.prestaged_offset = None
+        self.upcoming = []
+        self.status = {'upcoming_tools': []}
+        self.status_version = 0
+        if self.enabled:
+            self.printer.register_event_handler('klippy:ready',
+                                                self._handle_ready)
+
+    def _handle_ready(self):
+        self.sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        self.toolhead = self.printer.lookup_object('toolhead')
+        if self.sdcard is None:
+            logging.info("Toolchanger: lookahead_preheat needs [virtual_sdcard]")
+            return
+        self.reactor.register_timer(self._timer_event, self.reactor.NOW)
+
+    def _timer_event(self, eventtime):
+        try:
+            self._update(eventtime)
+        except Exception:
+            logging.exception("Toolchanger: lookahead failed")
+            self._reset()
+        return eventtime + self.interval
+
+    def _reset(self):
+        if self.scanner:
+            self.scanner.close()
+        self.scanner = None
+        self.preheated.clear()
+        self.prestaged_offset = None
+        self.upcoming = []
+        self._update_status()
+
+    def _update(self, eventtime):
+        path = self.sdcard.file_path() if self.sdcard.is_active() else None
+        if path is None:
+            if self.scanner:
+                self._reset()
+            return
+        if self.scanner is None or self.scanner.path != path:
+            self._reset()
+            max_velocity = self.toolhead.get_status(eventtime)['max_velocity']
+            self.scanner = GcodeToolScanner(self.toolchanger, path,
+                                            max_velocity)
+        scanner = self.scanner
+        file_position = self.sdcard.file_position
+        if scanner.offset < file_position:
+            # Catch up with the print first
+            scanner.scan(0., file_position)
+            if scanner.offset < file_position:
+                return
+        now = scanner.time_at(file_position)
+        scanner.scan(now + self.lookahead_time)
+        self.upcoming = []
+        seen = set()
+        for event in scanner.events:
+            if event.tool in seen:
+                continue
+            seen.add(event.tool)
+            self.upcoming.append((event.tool, event.time - now))
+            if self.preheat:
+                self._check_preheat(event, event.time - now)
+        self._update_status()
+        if self.prestage and scanner.events:
+            event = scanner.events[0]
+            self._check_prestage(event, event.time - now)
+
+    def _check_preheat(self, event, time_left):
+        tool = event.tool
+        if tool == self.toolchanger.active_tool or not tool.heater:
+            return
+        if time_left > tool.preheat_time:
+            return
+        if self.preheated.get(tool) == event.offset:
+            return
+        temperature = event.temperature or tool.last_active_temperature
+        if not temperature:
+            return
+        self.preheated[tool] = event.offset
+        if tool.heater.get_temp(self.reactor.monotonic())[1] >= temperature:
+            return
+        logging.info("Toolchanger: preheating %s to %.1f, needed in %.1fs",
+                     tool.name, temperature, time_left)
+        self.toolchanger.set_tool_temperature(tool, temperature)
+
+    def _check_prestage(self, event, time_left):
+        # Only the next tool change, while not changing tools.
+        tool = event.tool
+        toolchanger = self.toolchanger
+        if (tool == toolchanger.active_tool or tool == toolchanger.prestaged_tool
+                or not toolchanger.is_ready()):
+            return
+        if time_left > tool.prestage_time or self.prestaged_offset == event.offset:
+            return
+        self.prestaged_offset = event.offset
+        logging.info("Toolchanger: prestaging %s, needed in %.1fs",
+                     tool.name, time_left)
+        if tool.tool_number >= 0:
+            script = "PRESTAGE_TOOL T=%d" % (tool.tool_number,)
+        else:
+            script = "PRESTAGE_TOOL TOOL='%s'" % (tool.name,)
+        try:
+            self.toolchanger.gcode.run_script(script)
+        except self.toolchanger.gcode.error as e:
+            logging.info("Toolchanger: prestaging %s failed: %s",
+                         tool.name, str(e))
+
+    def get_upcoming(self):
+        return self.upcoming
+
+    def _update_status(self):
+        upcoming = [[tool.name, round(time_left, 1)]
+                    for tool, time_left in self.upcoming]
+        if upcoming != self.status['upcoming_tools']:
+            self.status = {'upcoming_tools': upcoming}
+            self.status_version += 1
+
+    def get_status(self, eventtime):
+        return self.status
+
+def scan_tool_changes(path, pause=None, chunk_size=ANALYZE_CHUNK_BYTES):
+    """Tool changes in a gcode file, as T numbers or SELECT_TOOL tool names.
+
+    The file is memory mapped and searched in chunks, calling pause()
+    in between. Repeated selects of the same tool are left out."""
+    changes = []
+    def add(match):
+        tool = _tool_change_id(match)
+        if tool is not None and (not changes or changes[-1] != tool):
+            changes.append(tool)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return changes
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            match = FIRST_TOOL_CHANGE_LINE_RE.match(data)
+            if match:
+                add(match)
+            start = 0
+            while start < size:
+                # Chunks end at a line end
+                end = min(start + chunk_size, size)
+                if end < size:
+                    nl = data.find(b'\n', end - 1)
+                    end = size if nl < 0 else nl + 1
+                # Starting from the line end of the previous chunk
+                for match in TOOL_CHANGE_LINE_RE.finditer(
+                        data, max(start - 1, 0), end):
+                    add(match)
+                start = end
+                if pause is not None and start < size:
+                    pause()
+    return changes
+
+def _tool_change_id(match):
+    if match.group(1) is not None:
+        return int(match.group(1))
+    arg = SELECT_TOOL_ARG_RE.search(match.group(2))
+    if arg is None:
+        return None
+    if arg.group(1) is not None:
+        return int(arg.group(1))
+    name = arg.group(2) or arg.group(3) or arg.group(4) or b''
+    return name.decode('utf-8', 'ignore')
+
+class FileAnalyzer:
+    """Pre-flight check of the tool changes in a print file.
+
+    Scan results are indexed by file path, size and mtime, analyzing the
+    same file again only looks up the registered tools and timing."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.toolchanger = toolchanger
+        path = config.get('analyze_index_path', None)
+        self.index_path = os.path.expanduser(path) if path else None
+        self.index = None
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command("TOOLCHANGER_ANALYZE_FILE",
+                                    self.cmd_TOOLCHANGER_ANALYZE_FILE,
+                                    desc=self.cmd_TOOLCHANGER_ANALYZE_FILE_help)
+
+    def _load_index(self):
+        self.index = collections.OrderedDict()
+        if self.index_path and os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.index.update(json.load(f))
+            except (OSError, ValueError):
+                logging.exception("Toolchanger: unable to read %s",
+                                  self.index_path)
+
+    def _save_index(self):
+        if not self.index_path:
+            return
+        tmp_path = self.index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.index, f, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            logging.exception("Toolchanger: unable to write %s",
+                              self.index_path)
+
+    def get_tool_changes(self, path):
+        """Returns the tool changes in the file and if they were cached."""
+        if self.index is None:
+            self._load_index()
+        st = os.stat(path)
+        key = '%s|%d|%d' % (os.path.realpath(path), st.st_size,
+                            st.st_mtime_ns)
+        changes = self.index.get(key)
+        if changes is not None:
+            self.index.move_to_end(key)
+            return changes, True
+        pause = lambda: self.reactor.pause(self.reactor.monotonic() + .001)
+        changes = scan_tool_changes(path, pause)
+        # Drop the older versions of the file
+        prefix = key.rsplit('|', 2)[0] + '|'
+        for old_key in [k for k in self.index if k.startswith(prefix)]:
+            del self.index[old_key]
+        self.index[key] = changes
+        while len(self.index) > ANALYZE_INDEX_SIZE:
+            self.index.popitem(last=False)
+        self._save_index()
+        return changes, False
+
+    def _lookup(self, tool_id):
+        toolchanger = self.toolchanger
+        if isinstance(tool_id, int):
+            return toolchanger.lookup_tool(tool_id)
+        return toolchanger.registry.by_name.get(tool_id)
+
+    def _estimate_change_time(self, counts):
+        stats = self.toolchanger.profiler.get_stats()
+        times = {name: phases['total']['p50']
+                 for name, phases in stats.items() if 'total' in phases}
+        if not times:
+            return None
+        default = sum(times.values()) / len(times)
+        return sum(times.get(tool.name, default) * count
+                   for tool, count in counts.items())
+
+    def _get_path(self, gcmd):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        filename = gcmd.get('FILE', None)
+        if filename is None:
+            path = sdcard.file_path() if sdcard is not None else None
+            if path is None:
+                raise gcmd.error("No FILE specified and no file loaded")
+            return path
+        if sdcard is not None and not os.path.isabs(filename):
+            filename = os.path.join(sdcard.sdcard_dirname, filename)
+        return os.path.expanduser(filename)
+
+    cmd_TOOLCHANGER_ANALYZE_FILE_help = ("Report the tool changes in a print "
+                                         "file and check the tools are assigned")
+    def cmd_TOOLCHANGER_ANALYZE_FILE(self, gcmd):
+        path = self._get_path(gcmd)
+        try:
+            changes, cached = self.get_tool_changes(path)
+        except OSError as e:
+            raise gcmd.error("Unable to read %s: %s" % (path, str(e)))
+        counts = collections.Counter()
+        unknown = []
+        for tool_id in changes:
+            tool = self._lookup(tool_id)
+            if tool is None:
+                if tool_id not in unknown:
+                    unknown.append(tool_id)
+            else:
+                counts[tool] += 1
+        used = sorted(set(changes), key=lambda t: (isinstance(t, str), t))
+        lines = ['%s: %d tool changes%s' % (
+            os.path.basename(path), len(changes), ' (cached)' if cached else '')]
+        lines.append('Tools used: %s' % (
+            ', '.join(_format_tool_id(t) for t in used) or 'none',))
+        if unknown:
+            lines.append('Not assigned: %s' % (
+                ', '.join(_format_tool_id(t) for t in unknown),))
+        if changes:
+            order = ' > '.join(_format_tool_id(t)
+                               for t in changes[:ANALYZE_REPORT_ORDER])
+            if len(changes) > ANALYZE_REPORT_ORDER:
+                order += ' > ...'
+            lines.append('Order: %s' % (order,))
+        change_time = self._estimate_change_time(counts)
+        if change_time is not None:
+            lines.append('Estimated tool change time: %.0fs' % (change_time,))
+        gcmd.respond_info('\n'.join(lines))
+        if unknown and gcmd.get_int('STRICT', 0) == 1:
+            raise gcmd.error('Print file uses tools that are not assigned: %s'
+                             % (', '.join(_format_tool_id(t) for t in unknown),))
+
+def _format_tool_id(tool_id):
+    if isinstance(tool_id, int):
+        return 'T%d' % (tool_id,)
+    return tool_id
@@ -0,0 +1,160 @@
+# Side-car store for saved tool parameters
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import ast, json, logging, os, threading
+
+# Seconds to collect saved parameters before writing them out together.
+WRITE_DELAY = 0.5
+# Seconds to wait before retrying a failed write.
+RETRY_DELAY = 10.
+
+class ToolParameterStore:
+    """Keeps saved tool parameters in a JSON file next to the config.
+
+    Stored values are applied on top of the config at connect, saving a
+    parameter takes effect immediately and does not need SAVE_CONFIG and a
+    restart. Saves made close together are written out in one atomic file
+    replace, by a background thread. Without a store path, parameters are
+    saved to pending config changes, like before."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.toolchanger = toolchanger
+        path = config.get('parameter_store_path', None)
+        self.path = os.path.expanduser(path) if path else None
+        self.sync_config = config.getboolean('parameter_store_sync_config',
+                                             False)
+        # Section name -> parameter name -> value repr
+        self.values = {}
+        self.dirty = False
+        self.write_timer = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = None
+        self.stopping = False
+        self.thread = None
+        if self.path:
+            self.printer.register_event_handler('klippy:connect',
+                                                self._handle_connect)
+            self.printer.register_event_handler('klippy:disconnect',
+                                                self._handle_disconnect)
+            # The main toolchanger is the default, when TOOLCHANGER is omitted.
+            name = toolchanger.name
+            mux_value = None if name == 'toolchanger' else name
+            gcode = self.printer.lookup_object('gcode')
+            gcode.register_mux_command("SYNC_TOOL_PARAMETERS", "TOOLCHANGER",
+                                       mux_value,
+                                       self.cmd_SYNC_TOOL_PARAMETERS,
+                                       desc=self.cmd_SYNC_TOOL_PARAMETERS_help)
+
+    def is_enabled(self):
+        return self.path is not None
+
+    def _handle_connect(self):
+        self.write_timer = self.reactor.register_timer(self._write_event)
+        self.values = self._read()
+        self.thread = threading.Thread(target=self._writer,
+                                       name='tool-parameter-store',
+                                       daemon=True)
+        self.thread.start()
+        for section, params in self.values.items():
+            tool = self.printer.lookup_object(section, None)
+            if tool is None or getattr(tool, 'toolchanger', None) is not self.toolchanger:
+                logging.info("Toolchanger: ignoring stored parameters for %s",
+                             section)
+                continue
+            for name, value in params.items():
+                tool.load_parameter(name, ast.literal_eval(value))
+
+    def _handle_disconnect(self):
+        if self.thread is not None:
+            self._flush()
+            with self.lock:
+                self.stopping = True
+            self.wake.set()
+            self.thread.join(1.)
+            self.thread = None
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                values = json.load(f)
+            for params in values.values():
+                for value in params.values():
+                    ast.literal_eval(value)
+        except (OSError, ValueError, SyntaxError, AttributeError) as e:
+            raise self.printer.config_error(
+                "Unable to read tool parameter store %s: %s" % (
+                    self.path, str(e)))
+        return values
+
+    def save(self, tool, name, value):
+        if self.path is None or self.sync_config:
+            configfile = self.printer.lookup_object('configfile')
+            configfile.set(tool.name, name, value)
+        if self.path is None:
+            return
+        self.values.setdefault(tool.name, {})[name] = repr(value)
+        if not self.dirty:
+            self.dirty = True
+            self.reactor.update_timer(self.write_timer,
+                                      self.reactor.monotonic() + WRITE_DELAY)
+
+    def _write_event(self, eventtime):
+        self._flush()
+        return self.reactor.NEVER
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        values = {section: dict(params)
+                  for section, params in self.values.items()}
+        with self.lock:
+            self.pending = values
+        self.wake.set()
+
+    def _writer(self):
+        values = None
+        while True:
+            # Retry a failed write, unless newer values come in.
+            self.wake.wait(None if values is None else RETRY_DELAY)
+            self.wake.clear()
+            with self.lock:
+                if self.pending is not None:
+                    values, self.pending = self.pending, None
+                stopping = self.stopping
+            if values is not None and self._write(values):
+                values = None
+            if stopping:
+                break
+
+    def _write(self, values):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(values, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception("Toolchanger: unable to write %s", self.path)
+            return False
+        return True
+
+    cmd_SYNC_TOOL_PARAMETERS_help = ("Add stored tool parameters to pending "
+                                     "config changes, for SAVE_CONFIG")
+    def cmd_SYNC_TOOL_PARAMETERS(self, gcmd):
+        configfile = self.printer.lookup_object('configfile')
+        count = 0
+        for section, params in self.values.items():
+            for name, value in params.items():
+                configfile.set(section, name, ast.literal_eval(value))
+                count += 1
+        gcmd.respond_info("%d tool parameters added to pending config changes"
+                          % (count,))
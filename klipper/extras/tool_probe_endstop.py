@@ -106,6 +106,10 @@ class ToolProbeEndstop:
                 candidates.append(tool_probe)
         return candidates
 
+    def query_open_probes(self):
+        """Tool probes that are not triggered, the mounted tool ones."""
+        return self._query_open_tools()
+
     def _describe_tool_detection_issue(self, candidates):
         if len(candidates) == 1 :
             return 'OK'
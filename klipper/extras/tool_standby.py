@@ -0,0 +1,168 @@
+# Lower the temperature of idle tools
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import collections, logging
+
+STATE_ACTIVE = 'active'
+STATE_IDLE = 'idle'
+STATE_STANDBY = 'standby'
+STATE_REHEATING = 'reheating'
+# Heater turned off or set by the user, not touched until the next pickup.
+STATE_OFF = 'off'
+
+# Recent idle times needed to predict the next pickup.
+MIN_SAMPLES = 2
+
+class ToolStandbyState:
+    def __init__(self, tool, history):
+        self.tool = tool
+        self.state = STATE_OFF
+        self.docked_at = None
+        self.temperature = None  # Temperature to return to on pickup
+        self.reheat = True  # Reheat ahead of the expected pickup
+        self.check_at = None
+        self.idle_times = collections.deque(maxlen=history)
+
+    def expected_idle_time(self):
+        if len(self.idle_times) < MIN_SAMPLES:
+            return None
+        return sum(self.idle_times) / len(self.idle_times)
+
+class ToolStandby:
+    """Drops docked tools to standby_temperature after standby_delay.
+
+    Each tool keeps the time it spent docked between its recent uses. A
+    tool that is expected back within standby_delay + preheat_time is kept
+    hot, otherwise it goes to standby and is reheated preheat_time before
+    the expected pickup. Needs no print file, works with streamed prints."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.toolchanger = toolchanger
+        self.history = config.getint('standby_history', 5, minval=1)
+        # Per tool values, read here to provide the default.
+        config.getfloat('standby_temperature', None, minval=0.)
+        config.getfloat('standby_delay', None, minval=0.)
+        self.states = {}
+        self.timer = None
+        self.printer.register_event_handler('klippy:connect',
+                                            self._handle_connect)
+
+    def _handle_connect(self):
+        self.timer = self.reactor.register_timer(self._timer_event)
+
+    def _get_state(self, tool):
+        if tool is None or tool.standby_temperature is None or not tool.heater:
+            return None
+        state = self.states.get(tool)
+        if state is None:
+            state = self.states[tool] = ToolStandbyState(tool, self.history)
+        return state
+
+    def get_state(self, tool):
+        state = self.states.get(tool)
+        return state.state if state else None
+
+    def _set_state(self, state, value):
+        if state.state != value:
+            state.state = value
+            state.tool.status_version += 1
+
+    def _get_target(self, tool, eventtime):
+        return tool.heater.get_temp(eventtime)[1]
+
+    def prepare_pickup(self, tool):
+        """Starts heating a tool in standby, before it is picked up."""
+        state = self._get_state(tool)
+        if state is None or state.state != STATE_STANDBY:
+            return
+        eventtime = self.reactor.monotonic()
+        if self._get_target(tool, eventtime) == tool.standby_temperature:
+            self.toolchanger.set_tool_temperature(tool, state.temperature)
+        state.check_at = None
+        self._set_state(state, STATE_REHEATING)
+
+    def note_tool_change(self, dropoff_tool, pickup_tool):
+        if dropoff_tool is pickup_tool:
+            return
+        eventtime = self.reactor.monotonic()
+        state = self._get_state(pickup_tool)
+        if state is not None:
+            self.prepare_pickup(pickup_tool)
+            if state.docked_at is not None:
+                state.idle_times.append(eventtime - state.docked_at)
+            state.docked_at = state.check_at = None
+            self._set_state(state, STATE_ACTIVE)
+        state = self._get_state(dropoff_tool)
+        if state is not None:
+            state.docked_at = eventtime
+            state.reheat = True
+            state.temperature = self._get_target(dropoff_tool, eventtime)
+            if state.temperature > dropoff_tool.standby_temperature:
+                state.check_at = eventtime + dropoff_tool.standby_delay
+                self._set_state(state, STATE_IDLE)
+            else:
+                state.check_at = None
+                self._set_state(state, STATE_OFF)
+        self.reactor.update_timer(self.timer, self._next_check())
+
+    def _next_check(self):
+        waketime = self.reactor.NEVER
+        for state in self.states.values():
+            if state.check_at is not None:
+                waketime = min(waketime, state.check_at)
+        return waketime
+
+    def _timer_event(self, eventtime):
+        for state in self.states.values():
+            if state.check_at is None or state.check_at > eventtime:
+                continue
+            state.check_at = None
+            try:
+                self._check(state, eventtime)
+            except Exception:
+                logging.exception("Toolchanger: standby of %s failed",
+                                  state.tool.name)
+                self._set_state(state, STATE_OFF)
+        return self._next_check()
+
+    def _check(self, state, eventtime):
+        tool = state.tool
+        target = self._get_target(tool, eventtime)
+        expected = (tool.standby_temperature if state.state == STATE_STANDBY
+                    else state.temperature)
+        if target != expected:
+            # Changed by the user or the print, leave it alone.
+            self._set_state(state, STATE_OFF)
+            return
+        if state.state == STATE_IDLE:
+            idle_time = state.expected_idle_time() if state.reheat else None
+            if idle_time is not None:
+                next_use = state.docked_at + idle_time
+                if next_use - tool.preheat_time <= eventtime:
+                    # Needed again soon, keep it hot. Go to standby if the
+                    # tool is not picked up by then, without reheating.
+                    state.reheat = False
+                    state.check_at = (max(next_use, eventtime)
+                                      + tool.standby_delay)
+                    return
+                state.check_at = next_use - tool.preheat_time
+            logging.info("Toolchanger: %s to standby at %.1f", tool.name,
+                         tool.standby_temperature)
+            self.toolchanger.set_tool_temperature(tool,
+                                                  tool.standby_temperature)
+            self._set_state(state, STATE_STANDBY)
+        elif state.state == STATE_STANDBY:
+            logging.info("Toolchanger: reheating %s to %.1f", tool.name,
+                         state.temperature)
+            self.toolchanger.set_tool_temperature(tool, state.temperature)
+            state.check_at = eventtime + tool.preheat_time + tool.standby_delay
+            self._set_state(state, STATE_REHEATING)
+        elif state.state == STATE_REHEATING:
+            # Not picked up as expected, do not reheat again.
+            self.toolchanger.set_tool_temperature(tool,
+                                                  tool.standby_temperature)
+            self._set_state(state, STATE_STANDBY)
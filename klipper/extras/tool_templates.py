@@ -0,0 +1,192 @@
+# Template loading and rendering for tool change gcode
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import logging, time, traceback
+import jinja2.meta, jinja2.nodes
+
+# Context that is versioned, static, or part of the render cache key.
+CACHEABLE_CONTEXT = ('tool', 'toolchanger', 'printer', 'dropoff_tool',
+                     'pickup_tool', 'prestage_tool', 'prestaged_tool')
+KEY_CONTEXT = ('dropoff_tool', 'pickup_tool', 'prestage_tool',
+               'prestaged_tool')
+# Status fields that change on every tool change.
+VOLATILE_FIELDS = {
+    'tool': {'active', 'usage'},
+    'toolchanger': {'status', 'tool', 'tool_number', 'change_stats',
+                    'last_change_times', 'upcoming_tools', 'prestaged_tool',
+                    'tool_presence_history'},
+}
+# Printer status that does not change while running.
+STATIC_PRINTER_FIELDS = {('configfile', 'config'), ('configfile', 'settings')}
+# Limit on cached scripts, cleared when full.
+MAX_RENDERED = 256
+
+class TemplateInfo:
+    def __init__(self, cacheable, names=()):
+        self.cacheable = cacheable
+        self.uses_tool = 'tool' in names
+        self.uses_toolchanger = 'toolchanger' in names
+        self.uses_printer = 'printer' in names
+
+def _access_path(node):
+    # Returns (name, field, ...) for constant field accesses, like
+    # printer.configfile.config["stepper_z"].
+    path = []
+    while not isinstance(node, jinja2.nodes.Name):
+        if isinstance(node, jinja2.nodes.Getattr):
+            path.append(node.attr)
+        elif (isinstance(node, jinja2.nodes.Getitem)
+              and isinstance(node.arg, jinja2.nodes.Const)):
+            path.append(node.arg.value)
+        else:
+            return None
+        node = node.node
+    path.append(node.name)
+    return tuple(reversed(path))
+
+def analyze_template(ast):
+    """Find out if the rendered script only depends on the cacheable context.
+
+    The tool and toolchanger may only be used through constant field names
+    that are not volatile, the printer only for the static fields."""
+    names = jinja2.meta.find_undeclared_variables(ast)
+    if not names.issubset(CACHEABLE_CONTEXT):
+        return TemplateInfo(False)
+    paths = [_access_path(node) for node in ast.find_all(
+        (jinja2.nodes.Getattr, jinja2.nodes.Getitem))]
+    for name in names.difference(KEY_CONTEXT):
+        depth = 2 if name == 'printer' else 1
+        fields = [p[1:] for p in paths
+                  if p and p[0] == name and len(p) == depth + 1]
+        uses = sum(1 for n in ast.find_all(jinja2.nodes.Name)
+                   if n.name == name)
+        if len(fields) != uses:
+            return TemplateInfo(False)
+        if name == 'printer':
+            if not STATIC_PRINTER_FIELDS.issuperset(fields):
+                return TemplateInfo(False)
+        elif any(f[0] in VOLATILE_FIELDS[name] for f in fields):
+            return TemplateInfo(False)
+    return TemplateInfo(True, names)
+
+class TemplateSource:
+    def __init__(self, script, info):
+        self.script = script
+        self.info = info
+        self.template = None  # Compiled on first use
+
+class ToolTemplate:
+    """A gcode_macro style template, compiled on first render.
+
+    Templates with the same script share the source and the compiled
+    template."""
+    def __init__(self, cache, name, source):
+        self.cache = cache
+        self.name = name
+        self.source = source
+
+    def create_template_context(self, eventtime=None):
+        return self.cache.gcode_macro.create_template_context(eventtime)
+
+    def render(self, context=None):
+        if context is None:
+            context = self.create_template_context()
+        try:
+            template = self.cache.compile(self.source)
+            return str(template.render(context))
+        except Exception as e:
+            msg = "Error evaluating '%s': %s" % (
+                self.name, traceback.format_exception_only(type(e), e)[-1])
+            logging.exception(msg)
+            raise self.cache.printer.lookup_object('gcode').error(msg)
+
+class TemplateCache:
+    """Loads tool change templates and caches the rendered scripts.
+
+    Templates are parsed when loaded, to report syntax errors at startup,
+    and compiled on first use. Identical scripts, like the ones tools
+    inherit from the toolchanger, are parsed and compiled once.
+    Templates that only use the tool, toolchanger, tool names and the static
+    printer config are rendered once per status version of the tool and
+    toolchanger."""
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.gcode_macro = self.printer.load_object(config, 'gcode_macro')
+        self.sources = {}  # script -> TemplateSource
+        self.rendered = {}
+        # Startup report
+        self.loaded = 0
+        self.load_time = 0.
+        self.compiled = 0
+        self.compile_time = 0.
+
+    def load_template(self, config, option, default=None):
+        start_time = time.perf_counter()
+        name = "%s:%s" % (config.get_name(), option)
+        if default is None:
+            script = config.get(option)
+        else:
+            script = config.get(option, default)
+        source = self.sources.get(script)
+        if source is None:
+            try:
+                ast = self.gcode_macro.env.parse(script)
+            except Exception as e:
+                msg = "Error loading template '%s': %s" % (
+                    name, traceback.format_exception_only(type(e), e)[-1])
+                logging.exception(msg)
+                raise config.error(msg)
+            source = TemplateSource(script, analyze_template(ast))
+            self.sources[script] = source
+        self.loaded += 1
+        self.load_time += time.perf_counter() - start_time
+        return ToolTemplate(self, name, source)
+
+    def compile(self, source):
+        if source.template is None:
+            start_time = time.perf_counter()
+            source.template = self.gcode_macro.env.from_string(source.script)
+            self.compiled += 1
+            self.compile_time += time.perf_counter() - start_time
+        return source.template
+
+    def get_load_report(self):
+        return ("%d templates, %d distinct, loaded in %.1f ms" % (
+            self.loaded, len(self.sources), self.load_time * 1000.))
+
+    def render(self, toolchanger, template, extra_context, tool=None):
+        # The tool is the active tool, unless given.
+        if tool is None:
+            tool = toolchanger.active_tool
+        source = template.source
+        info = source.info
+        key = None
+        if info.cacheable:
+            key = (id(source), id(toolchanger),
+                   tuple(extra_context.get(n) for n in KEY_CONTEXT),
+                   (tool, tool.status_version if tool else None)
+                   if info.uses_tool else None,
+                   toolchanger.status_version
+                   if info.uses_toolchanger else None)
+            script = self.rendered.get(key)
+            if script is not None:
+                return script
+        curtime = self.printer.get_reactor().monotonic()
+        if key is None or info.uses_printer:
+            context = template.create_template_context()
+        else:
+            context = {}
+        context.update({
+            'tool': tool.get_status(curtime) if tool else {},
+            'toolchanger': toolchanger.get_status(curtime),
+            **extra_context,
+        })
+        script = template.render(context)
+        if key is not None:
+            if len(self.rendered) >= MAX_RENDERED:
+                self.rendered.clear()
+            self.rendered[key] = script
+        return script
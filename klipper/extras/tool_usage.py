@@ -0,0 +1,172 @@
+# Per tool usage counters
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+import json, logging, os, threading
+
+COUNTERS = ('pickups', 'dropoffs', 'failures', 'active_time', 'extruded')
+
+class ToolUsage:
+    """Counts pickups, dropoffs, failures, time selected and extruded
+    filament per tool.
+
+    Counters are kept in memory and written to usage_path on a slow timer,
+    on shutdown and on disconnect. The file is written by a background
+    thread, the latest counters win. Active time and extruded length are
+    sampled in print time with lookahead callbacks on tool activation and
+    deactivation, and at the estimated print time on each timer run. Each
+    update replaces the counters dict of the tool, so it can be used as is
+    in the tool status."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.reactor = self.printer.get_reactor()
+        self.toolchanger = toolchanger
+        path = config.get('usage_path', None)
+        self.path = os.path.expanduser(path) if path else None
+        self.flush_interval = config.getfloat('usage_flush_interval', 300.,
+                                              minval=1.)
+        self.counters = {}  # Tool name -> counter name -> value
+        self.dirty = False
+        self.timer = None
+        self.toolhead = None
+        # Sampling of the active tool: (tool, extruder, position, print time)
+        self.sample = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = None
+        self.stopping = False
+        self.thread = None
+        self.printer.register_event_handler('klippy:connect',
+                                            self._handle_connect)
+        if self.path:
+            self.printer.register_event_handler('klippy:shutdown',
+                                                self._handle_shutdown)
+            self.printer.register_event_handler('klippy:disconnect',
+                                                self._handle_disconnect)
+
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+        if self.path:
+            self.counters = self._read()
+            self.thread = threading.Thread(target=self._writer,
+                                           name='toolchanger-usage',
+                                           daemon=True)
+            self.thread.start()
+        self.timer = self.reactor.register_timer(
+            self._timer_event, self.reactor.monotonic() + self.flush_interval)
+
+    def _handle_shutdown(self):
+        self._update_sample(self._estimated_print_time(self.reactor.monotonic()))
+        self._flush()
+
+    def _handle_disconnect(self):
+        self._handle_shutdown()
+        if self.thread is not None:
+            with self.lock:
+                self.stopping = True
+            self.wake.set()
+            self.thread.join(1.)
+            self.thread = None
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                counters = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.info("Toolchanger: ignoring usage counters %s: %s",
+                         self.path, str(e))
+            return {}
+        return {name: {c: values.get(c, 0) for c in COUNTERS}
+                for name, values in counters.items()
+                if isinstance(values, dict)}
+
+    def _flush(self):
+        if self.thread is None or not self.dirty:
+            return
+        self.dirty = False
+        # The counters dicts of the tools are replaced, never modified.
+        with self.lock:
+            self.pending = dict(self.counters)
+        self.wake.set()
+
+    def _writer(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock:
+                counters, self.pending = self.pending, None
+                stopping = self.stopping
+            if counters is not None:
+                self._write(counters)
+            if stopping:
+                break
+
+    def _write(self, counters):
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(counters, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError:
+            logging.exception("Toolchanger: unable to write %s", self.path)
+
+    def _timer_event(self, eventtime):
+        self._update_sample(self._estimated_print_time(eventtime))
+        self._flush()
+        return eventtime + self.flush_interval
+
+    def get_counters(self, tool):
+        counters = self.counters.get(tool.name)
+        if counters is None:
+            counters = self.counters[tool.name] = dict.fromkeys(COUNTERS, 0)
+        return counters
+
+    def add(self, tool, **amounts):
+        counters = dict(self.get_counters(tool))
+        for name, amount in amounts.items():
+            counters[name] = round(counters[name] + amount, 3)
+        self.counters[tool.name] = counters
+        self.dirty = True
+
+    def _get_extruder_position(self, extruder):
+        return getattr(extruder, 'last_position', 0.)
+
+    def _estimated_print_time(self, eventtime):
+        return self.toolhead.mcu.estimated_print_time(eventtime)
+
+    def _update_sample(self, print_time):
+        if self.sample is None:
+            return
+        tool, extruder, position, start_time = self.sample
+        # The activation may be queued ahead of the estimated print time.
+        print_time = max(print_time, start_time)
+        new_position = self._get_extruder_position(extruder)
+        self.sample = (tool, extruder, new_position, print_time)
+        self.add(tool, active_time=print_time - start_time,
+                 extruded=new_position - position)
+
+    def activate(self, tool):
+        extruder = tool.extruder
+        if extruder is None:
+            extruder = self.toolhead.get_extruder()
+        self.toolhead.register_lookahead_callback(
+            lambda t: self.activate_at_time(t, tool, extruder))
+
+    def deactivate(self, tool):
+        self.toolhead.register_lookahead_callback(
+            lambda t: self.deactivate_at_time(t, tool))
+
+    def activate_at_time(self, print_time, tool, extruder):
+        self.sample = (tool, extruder, self._get_extruder_position(extruder),
+                       print_time)
+
+    def deactivate_at_time(self, print_time, tool):
+        if self.sample is not None and self.sample[0] is tool:
+            self._update_sample(print_time)
+            self.sample = None
@@ -4,9 +4,10 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 
-import ast, bisect, logging
+import ast, bisect, collections, logging, time
 from unittest.mock import sentinel
-from . import tool_probe_endstop
+from . import tool_probe_endstop, tool_lookahead, tool_templates, tool_journal
+from . import tool_params, tool_standby, tool_checkpoint, tool_usage
 
 STATUS_UNINITALIZED = 'uninitialized'
 STATUS_INITIALIZING = 'initializing'
@@ -26,6 +27,21 @@ DETECT_PRESENT = "mounted"
 
 _FUTURE = 9999999999999999.
 
+# Tool motion profile options: (target, status field, command parameter)
+MOTION_PROFILE_OPTIONS = {
+    'max_velocity': ('toolhead', 'max_velocity', None),
+    'max_accel': ('toolhead', 'max_accel', None),
+    'square_corner_velocity': ('toolhead', 'square_corner_velocity', None),
+    'pressure_advance': ('extruder', 'pressure_advance', 'ADVANCE'),
+    'pressure_advance_smooth_time': ('extruder', 'smooth_time', 'SMOOTH_TIME'),
+    'shaper_type_x': ('input_shaper', 'shaper_type_x', 'SHAPER_TYPE_X'),
+    'shaper_type_y': ('input_shaper', 'shaper_type_y', 'SHAPER_TYPE_Y'),
+    'shaper_freq_x': ('input_shaper', 'shaper_freq_x', 'SHAPER_FREQ_X'),
+    'shaper_freq_y': ('input_shaper', 'shaper_freq_y', 'SHAPER_FREQ_Y'),
+    'damping_ratio_x': ('input_shaper', 'damping_ratio_x', 'DAMPING_RATIO_X'),
+    'damping_ratio_y': ('input_shaper', 'damping_ratio_y', 'DAMPING_RATIO_Y'),
+}
+
 class ToolInterval:
     def __init__(self, start, tool):
         self.start = start
@@ -33,22 +49,33 @@ class ToolInterval:
         self.end = _FUTURE
 
 class ToolMissingHelper:
+    """Errors out if the detected tool does not match the active one.
+
+    Keeps a bisect-indexed history of active tool intervals in print time.
+    Detection changes are checked after tool_missing_delay by a single
+    timer, a newer change or tool activation supersedes a pending check."""
     def __init__(self, toolchanger, config):
         self.printer = config.get_printer()
         self.toolchanger = toolchanger
         self.reactor = self.printer.get_reactor()
         self.enabled = config.getboolean('abort_on_tool_missing', False)
         self.wait_time = config.getfloat('tool_missing_delay', 2.0, above=0.)
-        # Keep a log of last 10 active intervals. Probably an overkill.
+        self.history_size = config.getint('tool_missing_history', 10, minval=1)
+        # Active intervals, sorted by start print time.
+        self.interval_starts = []
         self.active_intervals = []
-        self.tool_lasttime = 0.
-        self.current_tool = None
+        self.check_seq = 0
+        self.pending_check = None  # (seq, print_time, detected tool)
+        self.check_timer = None
+        self.version = 0
+        self.status_cache = (None, None)  # (version, status)
         self.printer.register_event_handler('klippy:connect',
                                             self._handle_connect)
 
     def _handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
         self.sdcard = self.printer.lookup_object('virtual_sdcard')
+        self.check_timer = self.reactor.register_timer(self._check_event)
 
     def activate(self, tool):
         if self.enabled:
@@ -59,40 +86,381 @@ class ToolMissingHelper:
 
     def activate_at_time(self, time, tool):
         if len(self.active_intervals) == 0 or self.active_intervals[-1].end <= time:
+            self.interval_starts.append(time)
             self.active_intervals.append(ToolInterval(time, tool))
-        if len(self.active_intervals) > 10:
-            del self.active_intervals[0]
-        self.tool_lasttime = time
-        self.reactor.register_callback(lambda _: self._tool_change_delayed(time, tool), time + self.wait_time)
+            if len(self.active_intervals) > 2 * self.history_size:
+                del self.interval_starts[:-self.history_size]
+                del self.active_intervals[:-self.history_size]
+            self.version += 1
+        # Supersedes any pending detection check.
+        self.check_seq += 1
 
     def deactivate_at_time(self, time):
         if len(self.active_intervals) > 0 and self.active_intervals[-1].end >= time:
             self.active_intervals[-1].end = time
-        self.activate_lasttime = 0.
+            self.version += 1
 
     def note_tool_change(self, eventtime, current_tool):
+        if not self.enabled:
+            return
         logging.info(f"Tool change to {current_tool} - detected, waiting... ")
-        self.tool_lasttime = eventtime
-        self.current_tool = current_tool
-        self.reactor.register_callback(lambda _: self._tool_change_delayed(eventtime, current_tool),
-                                       eventtime + self.wait_time)
-
-    def find_interval_at(self, eventtime):
-        return next((i for i in self.active_intervals if i.start <= eventtime <= i.end), None)
-
-    def _tool_change_delayed(self, time, current_tool):
-        interval = self.find_interval_at(time)
+        self.check_seq += 1
+        print_time = self.toolhead.mcu.estimated_print_time(eventtime)
+        self.pending_check = (self.check_seq, print_time, current_tool)
+        self.reactor.update_timer(self.check_timer, eventtime + self.wait_time)
+
+    def find_interval_at(self, print_time):
+        i = bisect.bisect_right(self.interval_starts, print_time) - 1
+        if i >= 0 and self.active_intervals[i].end >= print_time:
+            return self.active_intervals[i]
+        return None
+
+    def _check_event(self, eventtime):
+        check, self.pending_check = self.pending_check, None
+        if check is None:
+            return self.reactor.NEVER
+        seq, print_time, current_tool = check
+        interval = self.find_interval_at(print_time)
         if interval is None:
             logging.info(f"Tool change to {current_tool}, no active tool requested, ignoring")
-        elif self.tool_lasttime != time:
+        elif seq != self.check_seq:
             logging.info(f"Tool change to {current_tool} ignored, changed again before timeout")
         elif not self.sdcard.is_active():
             logging.info(f"Tool change to {current_tool} ignored, not printing")
-        elif interval and interval.tool == current_tool:
+        elif interval.tool == current_tool:
             logging.info(f"Tool change to {current_tool}, as expected")
         else:
-            logging.error(f"Tool change to{current_tool} at {time} - mismatch after wait time, expected {interval}, erroring out!!!")
+            logging.error(f"Tool change to {current_tool} at {print_time} - mismatch after wait time, expected {interval.tool}, erroring out!!!")
             self.toolchanger.process_error(None, "Tool no longer attached.")
+        return self.reactor.NEVER
+
+    def get_status(self, eventtime):
+        if self.status_cache[0] != self.version:
+            self.status_cache = (self.version, {'tool_presence_history': [
+                [i.tool.name if i.tool else None, round(i.start, 3),
+                 round(i.end, 3) if i.end < _FUTURE else None]
+                for i in self.active_intervals[-self.history_size:]]})
+        return self.status_cache[1]
+
+# Bounds for the learned detection timeout, when not configured. Only the
+# waits that blocked are sampled, the learned timeout is never shorter than
+# the fixed wait used before.
+DETECT_DEFAULT_TIMEOUT = 0.5
+DETECT_MIN_TIMEOUT = 0.2
+# Learned timeout is this many times the slowest recent settle time.
+DETECT_TIMEOUT_MARGIN = 3.
+DETECT_MIN_SAMPLES = 5
+
+class ToolDetectWaiter:
+    """Waits for the detection pins to report an expected tool.
+
+    Wakes up as soon as the detection changes to the expected tool, instead
+    of sleeping a fixed time. Keeps recent settle times per tool to pick a
+    tighter timeout when tool_detect_timeout is not configured."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.toolchanger = toolchanger
+        self.reactor = self.printer.get_reactor()
+        self.timeout = config.getfloat('tool_detect_timeout', None, above=0.)
+        self.window = config.getint('stats_window', 100, minval=1)
+        self.waiters = []  # (expected tool, completion)
+        self.async_checks = []
+        self.settle_times = {}  # Tool name -> deque of seconds
+
+    def get_timeout(self, tool):
+        timeout = tool.detect_timeout if tool else self.timeout
+        if timeout is not None:
+            return timeout
+        samples = self.settle_times.get(tool.name if tool else None)
+        if not samples or len(samples) < DETECT_MIN_SAMPLES:
+            return DETECT_DEFAULT_TIMEOUT
+        return min(DETECT_DEFAULT_TIMEOUT,
+                   max(DETECT_MIN_TIMEOUT,
+                       DETECT_TIMEOUT_MARGIN * max(samples)))
+
+    def wait_for(self, expected):
+        """Wait until detected_tool is expected, or timeout. Call after
+        toolhead.wait_moves(). Returns True if the expected tool was
+        detected."""
+        if self.toolchanger.detected_tool == expected:
+            return True
+        start = self.reactor.monotonic()
+        completion = self.reactor.completion()
+        waiter = (expected, completion)
+        self.waiters.append(waiter)
+        try:
+            eventtime = completion.wait(start + self.get_timeout(expected))
+        finally:
+            self.waiters.remove(waiter)
+        if eventtime is None:
+            return False
+        self._record_settle(expected, eventtime - start)
+        return True
+
+    def verify_async(self, expected, on_mismatch):
+        """Check the detected tool once the moves queued so far are done,
+        without waiting for them. Calls on_mismatch(expected) if the
+        expected tool is not detected within the timeout."""
+        toolhead = self.printer.lookup_object('toolhead')
+        check = {'expected': expected, 'start': None, 'timer': None}
+        def timer_handler(eventtime):
+            if check['start'] is None:
+                check['start'] = eventtime
+                if self.toolchanger.detected_tool != expected:
+                    return eventtime + self.get_timeout(expected)
+            self._remove_async(check)
+            if self.toolchanger.detected_tool != expected:
+                on_mismatch(expected)
+            return self.reactor.NEVER
+        def schedule(print_time):
+            if check not in self.async_checks:
+                return
+            now = self.reactor.monotonic()
+            delay = print_time - toolhead.mcu.estimated_print_time(now)
+            check['timer'] = self.reactor.register_timer(
+                timer_handler, now + max(0., delay))
+        self.async_checks.append(check)
+        toolhead.register_lookahead_callback(schedule)
+
+    def _remove_async(self, check):
+        # Every check owns its timer, unregister it on any exit.
+        self.async_checks.remove(check)
+        if check['timer'] is not None:
+            self.reactor.unregister_timer(check['timer'])
+            check['timer'] = None
+
+    def cancel_async(self):
+        for check in list(self.async_checks):
+            self._remove_async(check)
+
+    def note_detect_change(self, detected, eventtime):
+        for expected, completion in self.waiters:
+            if expected == detected and not completion.test():
+                completion.complete(eventtime)
+        for check in list(self.async_checks):
+            if check['start'] is not None and check['expected'] == detected:
+                self._remove_async(check)
+                self._record_settle(detected, eventtime - check['start'])
+
+    def _record_settle(self, tool, settle_time):
+        name = tool.name if tool else None
+        if name not in self.settle_times:
+            self.settle_times[name] = collections.deque(maxlen=self.window)
+        self.settle_times[name].append(max(0., settle_time))
+
+    def get_settle_time(self, tool):
+        samples = self.settle_times.get(tool.name if tool else None)
+        return max(samples) if samples else None
+
+class ToolRegistry:
+    """Tools indexed by number and section name.
+
+    The indexes and detection counts are updated incrementally on tool
+    registration and number assignment. Detected tools are kept as a
+    bitmask, with a bit per registered tool."""
+    def __init__(self):
+        self.by_name = {}
+        self.by_number = {}
+        # Ordered list of registered tool numbers and the tool names in the
+        # same order. Replaced instead of modified, they are used as is in
+        # the toolchanger status.
+        self.numbers = []
+        self.names = []
+        self.with_detection = 0
+        self.with_probe = 0
+        self.present_mask = 0  # Bits of the numbered tools that are detected.
+        self.bits = {}  # Tool -> bit
+        self.by_bit_index = []
+
+    def register(self, tool):
+        self.by_name[tool.name] = tool
+        if tool not in self.bits:
+            self.bits[tool] = 1 << len(self.by_bit_index)
+            self.by_bit_index.append(tool)
+
+    def assign(self, tool, number, prev_number, replace=False):
+        other = self.by_number.get(number)
+        if other is not None and other is not tool and not replace:
+            raise Exception('Duplicate tools with number %s' % (number,))
+        if self.by_number.get(prev_number) is tool:
+            self._unassign(prev_number)
+        if number in self.by_number:
+            self._unassign(number)
+        self.by_number[number] = tool
+        position = bisect.bisect_left(self.numbers, number)
+        self.numbers = self.numbers[:position] + [number] + self.numbers[position:]
+        self.names = self.names[:position] + [tool.name] + self.names[position:]
+        if tool.detect_state != DETECT_UNAVAILABLE:
+            self.with_detection += 1
+        if tool.probe is not None:
+            self.with_probe += 1
+        self.note_detect(tool)
+
+    def _unassign(self, number):
+        tool = self.by_number.pop(number)
+        position = bisect.bisect_left(self.numbers, number)
+        self.numbers = self.numbers[:position] + self.numbers[position + 1:]
+        self.names = self.names[:position] + self.names[position + 1:]
+        if tool.detect_state != DETECT_UNAVAILABLE:
+            self.with_detection -= 1
+        if tool.probe is not None:
+            self.with_probe -= 1
+        self.present_mask &= ~self.bits[tool]
+
+    def note_detect(self, tool):
+        if (tool.detect_state == DETECT_PRESENT
+                and self.by_number.get(tool.tool_number) is tool):
+            self.present_mask |= self.bits[tool]
+        else:
+            self.present_mask &= ~self.bits[tool]
+
+    def get_detected(self):
+        """Returns the detected tool, None if no or multiple tools."""
+        mask = self.present_mask
+        if mask and not mask & (mask - 1):
+            return self.by_bit_index[mask.bit_length() - 1]
+        return None
+
+    def get_present(self):
+        mask = self.present_mask
+        return [tool for tool in self.by_bit_index if mask & self.bits[tool]]
+
+TOOLCHANGE_PHASES = ['home', 'save_state', 'before_change', 'dropoff',
+                     'configure', 'pickup', 'verify', 'after_change',
+                     'restore']
+
+class ToolchangeProfiler:
+    """Times each phase of a tool change in reactor and print time.
+
+    Keeps a rolling window of samples per picked up tool. Print times are
+    captured with lookahead callbacks, so the motion queue is not flushed.
+    Completed and failed changes are written to the journal."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.toolchanger = toolchanger
+        self.reactor = self.printer.get_reactor()
+        self.window = config.getint('stats_window', 100, minval=1)
+        self.history = {}  # Tool name -> phase -> deque of (time, print_time)
+        self.current = None
+        self.last_change = {}
+        self.stats_cache = None
+        self.version = 0
+        self.printer.register_event_handler('klippy:connect',
+                                            self._handle_connect)
+
+    def _handle_connect(self):
+        self.toolhead = self.printer.lookup_object('toolhead')
+
+    def start(self, tool, dropoff_tool):
+        key = tool.name if tool else 'none'
+        self.current = change = {'tool': key, 'marks': [], 'info': {
+            'from': dropoff_tool.name if dropoff_tool else None,
+            'to': tool.name if tool else None}}
+        self._add_mark(change, None)
+
+    def mark(self, phase):
+        if self.current is not None:
+            self._add_mark(self.current, phase)
+
+    def note(self, key, value):
+        # Extra info for the journal
+        if self.current is not None:
+            self.current['info'][key] = value
+
+    def _add_mark(self, change, phase):
+        mark = [phase, self.reactor.monotonic(), None]
+        change['marks'].append(mark)
+        def set_print_time(print_time):
+            mark[2] = print_time
+        self.toolhead.register_lookahead_callback(set_print_time)
+
+    def finish(self):
+        change = self.current
+        self.current = None
+        if change is None:
+            return
+        # Lookahead callbacks run in order, once this one runs, all the
+        # print times of this change are known.
+        self.toolhead.register_lookahead_callback(
+            lambda print_time: self._record(change))
+
+    def cancel(self):
+        self.current = None
+
+    def fail(self, message):
+        change = self.current
+        self.current = None
+        if change is None:
+            return
+        change['info']['err'] = message
+        self._add_mark(change, 'failed')
+        self.toolhead.register_lookahead_callback(
+            lambda print_time: self.toolchanger.journal.write(
+                self._journal_record(change, self._durations(change))))
+
+    def _durations(self, change):
+        marks = change['marks']
+        durations = {}
+        for prev, mark in zip(marks, marks[1:]):
+            durations[mark[0]] = (mark[1] - prev[1], mark[2] - prev[2])
+        durations['total'] = (marks[-1][1] - marks[0][1],
+                              marks[-1][2] - marks[0][2])
+        return durations
+
+    def _journal_record(self, change, durations):
+        marks = change['marks']
+        return {'pt': round(marks[0][2], 3), 'end': round(marks[-1][2], 3),
+                'ph': {phase: round(d[0], 4)
+                       for phase, d in durations.items()},
+                **change['info']}
+
+    def _record(self, change):
+        durations = self._durations(change)
+        self.toolchanger.journal.write(self._journal_record(change, durations))
+        history = self.history.setdefault(change['tool'], {})
+        for phase, sample in durations.items():
+            if phase not in history:
+                history[phase] = collections.deque(maxlen=self.window)
+            history[phase].append(sample)
+        self.last_change = {'tool': change['tool'],
+                            **{phase: round(d[0], 4)
+                               for phase, d in durations.items()}}
+        self.stats_cache = None
+        self.version += 1
+
+    def reset(self, tool_name=None):
+        if tool_name is None:
+            self.history.clear()
+        else:
+            self.history.pop(tool_name, None)
+        self.stats_cache = None
+        self.version += 1
+
+    def get_stats(self):
+        if self.stats_cache is None:
+            self.stats_cache = {
+                tool_name: {phase: _summarize(samples)
+                            for phase, samples in phases.items()}
+                for tool_name, phases in self.history.items()}
+        return self.stats_cache
+
+    def get_status(self, eventtime):
+        return {'change_stats': self.get_stats(),
+                'last_change_times': self.last_change}
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+def _summarize(samples):
+    times = sorted(s[0] for s in samples)
+    print_times = sorted(s[1] for s in samples)
+    return {'count': len(times),
+            'p50': round(_percentile(times, .5), 4),
+            'p95': round(_percentile(times, .95), 4),
+            'max': round(times[-1], 4),
+            'print_p50': round(_percentile(print_times, .5), 4),
+            'print_p95': round(_percentile(print_times, .95), 4),
+            'print_max': round(print_times[-1], 4)}
 
 class Toolchanger:
     def __init__(self, config):
@@ -101,40 +469,71 @@ class Toolchanger:
         self.gcode_macro = self.printer.load_object(config, 'gcode_macro')
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode_move = self.printer.load_object(config, 'gcode_move')
+        self.reactor = self.printer.get_reactor()
 
         self.name = config.get_name()
+        if config.get_name() == 'toolchanger':
+            self.templates = tool_templates.TemplateCache(config)
+        else:
+            self.templates = self.printer.load_object(
+                config, 'toolchanger').templates
+        start_time = time.perf_counter()
+        # Time spent loading the toolchanger and tool sections, reported at
+        # connect by the main toolchanger.
+        self.config_time = 0.
         self.params = get_params_dict(config)
         init_options = {'home': INIT_ON_HOME,
                         'manual': INIT_MANUAL, 'first-use': INIT_FIRST_USE}
         self.initialize_on = config.getchoice(
             'initialize_on', init_options, 'first-use')
         self.verify_tool_pickup = config.getboolean('verify_tool_pickup', True)
+        self.verify_tool_pickup_async = config.getboolean(
+            'verify_tool_pickup_async', False)
         self.require_tool_present = config.getboolean('require_tool_present', False)
         self.transfer_fan_speed = config.getboolean('transfer_fan_speed', True)
+        self.direct_gcode_state = config.getboolean('direct_gcode_state', True)
+        self.detect_debounce = config.getfloat('detect_debounce', 0., minval=0.)
         self.uses_axis = config.get('uses_axis', 'xyz').lower()
         home_options = {'abort': ON_AXIS_NOT_HOMED_ABORT,
                         'home': ON_AXIS_NOT_HOMED_HOME}
         self.on_axis_not_homed = config.getchoice('on_axis_not_homed',
                                                   home_options, 'abort')
-        self.initialize_gcode = self.gcode_macro.load_template(
+        self.initialize_gcode = self.templates.load_template(
             config, 'initialize_gcode', '')
-        self.error_gcode = self.gcode_macro.load_template(config, 'error_gcode') if config.get('error_gcode', None) else None
-        self.default_before_change_gcode = self.gcode_macro.load_template(
+        self.error_gcode = self.templates.load_template(config, 'error_gcode') if config.get('error_gcode', None) else None
+        if self.verify_tool_pickup_async and self.error_gcode is None:
+            raise config.error(
+                "verify_tool_pickup_async needs error_gcode to be defined")
+        self.default_before_change_gcode = self.templates.load_template(
             config, 'before_change_gcode', '')
-        self.default_after_change_gcode = self.gcode_macro.load_template(
+        self.default_after_change_gcode = self.templates.load_template(
             config, 'after_change_gcode', '')
 
         self.tool_missing_helper = ToolMissingHelper(self, config)
+        self.profiler = ToolchangeProfiler(self, config)
+        self.detect_waiter = ToolDetectWaiter(self, config)
+        self.journal = tool_journal.ToolchangeJournal(self, config)
+        self.preheater = tool_lookahead.ToolPreheater(self, config)
+        self.file_analyzer = tool_lookahead.FileAnalyzer(self, config)
+        self.parameter_store = tool_params.ToolParameterStore(self, config)
+        self.standby = tool_standby.ToolStandby(self, config)
+        self.checkpoint = tool_checkpoint.ToolchangerCheckpoint(self, config)
+        self.usage = tool_usage.ToolUsage(self, config)
 
         # Read all the fields that might be defined on toolchanger.
         # To avoid throwing config error when no tools configured.
         config.get('pickup_gcode', None)
         config.get('dropoff_gcode', None)
         config.get('recover_gcode', None)
+        config.get('prestage_gcode', None)
         config.getfloat('gcode_x_offset', None)
         config.getfloat('gcode_y_offset', None)
         config.getfloat('gcode_z_offset', None)
         config.get('t_command_restore_axis', None)
+        config.getint('pickup_retries', None)
+        config.getfloat('pickup_retry_path_speed', None)
+        for option in MOTION_PROFILE_OPTIONS:
+            config.get(option, None)
         config.get('extruder', None)
         config.get('fan', None)
         config.get_prefix_options('params_')
@@ -142,14 +541,24 @@ class Toolchanger:
         self.status = STATUS_UNINITALIZED
         self.active_tool = None
         self.detected_tool = None
+        self.detect_timer = None
+        self.detect_pending = False
+        self.detect_edge_time = 0.
+        self.prestaged_tool = None
         self.has_detection = False
-        self.tools = {}
-        self.tool_numbers = []  # Ordered list of registered tool numbers.
-        self.tool_names = []  # Tool names, in the same order as numbers.
+        self.registry = ToolRegistry()
         self.error_message = ''
         self.next_change_id = 1
         self.current_change_id = -1
+        self.last_change_gcode_position = None
+        self.last_change_gcode_offset = None
+        self.last_change_pickup_tool = None
+        self.last_change_restore_axis = ''
+        self.retrying_pickup = None  # Tool with pickup retries left
         self.gcode_transform = ToolGcodeTransform()
+        # Incremented on tool assignment and detection changes.
+        self.status_version = 0
+        self.status_cache = (None, None)
 
         self.printer.register_event_handler("gcode:command_error",
                                             self._handle_command_error)
@@ -192,11 +601,39 @@ class Toolchanger:
                                     self.cmd_SAVE_TOOL_PARAMETER)
         self.gcode.register_command("VERIFY_TOOL_DETECTED",
                                     self.cmd_VERIFY_TOOL_DETECTED)
+        self.gcode.register_command("PRESTAGE_TOOL",
+                                    self.cmd_PRESTAGE_TOOL,
+                                    desc=self.cmd_PRESTAGE_TOOL_help)
+        self.gcode.register_command("TOOL_PATH",
+                                    self.cmd_TOOL_PATH,
+                                    desc=self.cmd_TOOL_PATH_help)
         self.gcode.register_command("ADJUST_Z_AFTER_TOOL_NOZZLE_HOME",
                                     self.cmd_ADJUST_Z_AFTER_TOOL_NOZZLE_HOME)
+        self.gcode.register_command("TOOLCHANGE_STATS",
+                                    self.cmd_TOOLCHANGE_STATS,
+                                    desc=self.cmd_TOOLCHANGE_STATS_help)
         self.fan_switcher = None
+        self.extruder_switcher = ExtruderSwitcher(self, config)
+        self.motion_switcher = MotionProfileSwitcher(self, config)
         self.tool_probe_endstop = None
-        self.validate_tool_timer = None
+        self.note_config_time(start_time)
+
+    def note_config_time(self, start_time):
+        # The main toolchanger is registered after its init completes.
+        main_toolchanger = (self if self.name == 'toolchanger' else
+                            self.printer.lookup_object('toolchanger'))
+        main_toolchanger.config_time += time.perf_counter() - start_time
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        # Resets to uninitialized do not change the physical state.
+        if status != STATUS_UNINITALIZED:
+            self.checkpoint.note_status()
 
     def require_fan_switcher(self):
         if not self.fan_switcher:
@@ -209,62 +646,73 @@ class Toolchanger:
 
     def _handle_home_rails_begin(self, homing_state, rails):
         if self.initialize_on == INIT_ON_HOME and self.status == STATUS_UNINITALIZED:
-            self.initialize(self.detected_tool)
+            self._resume_or_initialize(True)
 
     def _handle_connect(self):
         self.status = STATUS_UNINITALIZED
         self.active_tool = None
+        self.detect_timer = self.reactor.register_timer(self._detect_event)
         self.gcode_transform.next_transform = self.gcode_move.set_move_transform(self.gcode_transform, force=True)
+        if self.name == 'toolchanger':
+            logging.info("Toolchanger: %d tools configured in %.1f ms, %s",
+                         len(self.registry.by_name), self.config_time * 1000.,
+                         self.templates.get_load_report())
 
     def _handle_command_error(self):
         self.status = STATUS_UNINITALIZED
         self.tool_missing_helper.deactivate()
         self.active_tool = None
-        self.gcode_transform.tool = None
+        self.gcode_transform.set_tool(None)
 
     def _handle_shutdown(self):
         self.status = STATUS_UNINITALIZED
+        self.detect_waiter.cancel_async()
         self.tool_missing_helper.deactivate_at_time(_FUTURE)
         self.active_tool = None
-        self.gcode_transform.tool = None
+        self.gcode_transform.set_tool(None)
 
     def get_status(self, eventtime):
-        return {**self.params,
+        key = (self.status_version, self.status, self.active_tool,
+               self.profiler.version, self.preheater.status_version,
+               self.tool_missing_helper.version)
+        if self.status_cache[0] == key:
+            return self.status_cache[1]
+        status = {**self.params,
                 'name': self.name,
                 'status': self.status,
                 'tool': self.active_tool.name if self.active_tool else None,
                 'tool_number': self.active_tool.tool_number if self.active_tool else -1,
                 'detected_tool': self.detected_tool.name if self.detected_tool else None,
                 'detected_tool_number': self.detected_tool.tool_number if self.detected_tool else -1,
-                'tool_numbers': self.tool_numbers,
-                'tool_names': self.tool_names,
+                'prestaged_tool': self.prestaged_tool.name if self.prestaged_tool else None,
+                'tool_numbers': self.registry.numbers,
+                'tool_names': self.registry.names,
                 'has_detection': self.has_detection,
+                **self.tool_missing_helper.get_status(eventtime),
+                **self.profiler.get_status(eventtime),
+                **self.preheater.get_status(eventtime),
                 }
+        self.status_cache = (key, status)
+        return status
+
+    def register_tool(self, tool):
+        self.registry.register(tool)
 
     def assign_tool(self, tool, number, prev_number, replace=False):
-        if number in self.tools and not replace:
-            raise Exception('Duplicate tools with number %s' % (number,))
-        if prev_number in self.tools:
-            del self.tools[prev_number]
-            self.tool_numbers.remove(prev_number)
-            self.tool_names.remove(tool.name)
-        self.tools[number] = tool
-        position = bisect.bisect_left(self.tool_numbers, number)
-        self.tool_numbers.insert(position, number)
-        self.tool_names.insert(position, tool.name)
-
-        self.has_detection = any([t.detect_state != DETECT_UNAVAILABLE for t in self.tools.values()])
-        all_detection = all([t.detect_state != DETECT_UNAVAILABLE for t in self.tools.values()])
-        if self.has_detection and not all_detection:
+        registry = self.registry
+        registry.assign(tool, number, prev_number, replace)
+        self.status_version += 1
+
+        tool_count = len(registry.by_number)
+        self.has_detection = registry.with_detection > 0
+        if self.has_detection and registry.with_detection < tool_count:
             raise self.config.error("Some tools missing detection pin")
-        has_probe = any([t.probe is not None for t in self.tools.values()])
-        all_probe = all([t.probe is not None for t in self.tools.values()])
-        if has_probe and not all_probe:
+        if 0 < registry.with_probe < tool_count:
             raise self.config.error("Some tools are missing tool_probe")
 
     cmd_INITIALIZE_TOOLCHANGER_help = "Initialize the toolchanger"
     def cmd_INITIALIZE_TOOLCHANGER(self, gcmd):
-        tool = self.gcmd_tool(gcmd, self.detected_tool)
+        tool = self.gcmd_tool(gcmd, self.get_stable_detected_tool())
         was_error  = self.status == STATUS_ERROR
         self.initialize(tool)
         if was_error and gcmd.get_int("RECOVER", default=0) == 1:
@@ -276,7 +724,7 @@ class Toolchanger:
     def cmd_SELECT_TOOL(self, gcmd):
         tool_name = gcmd.get('TOOL', None)
         if tool_name:
-            tool = self.printer.lookup_object(tool_name)
+            tool = self.lookup_tool_by_name(tool_name)
             if not tool:
                 raise gcmd.error("Select tool: TOOL=%s not found" % (tool_name))
             restore_axis = gcmd.get('RESTORE_AXIS', tool.t_command_restore_axis)
@@ -292,6 +740,32 @@ class Toolchanger:
             return
         raise gcmd.error("Select tool: Either TOOL or T needs to be specified")
 
+    cmd_PRESTAGE_TOOL_help = 'Prepare a tool for the next tool change'
+    def cmd_PRESTAGE_TOOL(self, gcmd):
+        if self.status != STATUS_READY:
+            raise gcmd.error("PRESTAGE_TOOL: toolchanger not ready: status = %s" % (self.status,))
+        tool = self._get_tool_from_gcmd(gcmd)
+        if tool == self.active_tool:
+            raise gcmd.error("Cannot prestage the active tool %s" % (tool.name,))
+        if tool == self.prestaged_tool:
+            return
+        self.prestage_tool(tool)
+
+    def prestage_tool(self, tool):
+        extra_context = {
+            'dropoff_tool': None,
+            'prestage_tool': tool.name,
+            'prestaged_tool': self.prestaged_tool.name if self.prestaged_tool else None,
+        }
+        self.run_gcode('tool.prestage_gcode', tool.prestage_gcode, extra_context,
+                       tool=tool)
+        self._set_prestaged_tool(tool)
+
+    def _set_prestaged_tool(self, tool):
+        if tool != self.prestaged_tool:
+            self.prestaged_tool = tool
+            self.status_version += 1
+
     cmd_SET_TOOL_TEMPERATURE_help = 'Set temperature for tool'
 
     def cmd_SET_TOOL_TEMPERATURE(self, gcmd):
@@ -302,6 +776,9 @@ class Toolchanger:
             raise gcmd.error(
                 "SET_TOOL_TEMPERATURE: No extruder or heater specified for tool %s" % (
                     tool.name))
+        self.set_tool_temperature(tool, temp, wait)
+
+    def set_tool_temperature(self, tool, temp, wait=False):
         heaters = self.printer.lookup_object('heaters')
         heaters.set_temperature(tool.heater, temp, wait)
 
@@ -309,7 +786,7 @@ class Toolchanger:
         tool_name = gcmd.get('TOOL', None)
         tool_nr = gcmd.get_int('T', None)
         if tool_name:
-            tool = self.printer.lookup_object(tool_name)
+            tool = self.lookup_tool_by_name(tool_name)
         elif tool_nr is not None:
             tool = self.lookup_tool(tool_nr)
             if not tool:
@@ -340,8 +817,8 @@ class Toolchanger:
         self.select_tool(gcmd, None, restore_axis)
 
     def cmd_ENTER_DOCKING_MODE(self, gcmd):
-        if self.status == STATUS_UNINITALIZED and self.initialize_on == INIT_FIRST_USE:
-            self.initialize(self.detected_tool)
+        if self.status == STATUS_UNINITALIZED:
+            self._resume_or_initialize(self.initialize_on == INIT_FIRST_USE)
         if self.status != STATUS_READY:
             raise gcmd.error(
                 "Cannot enter docking mode, toolchanger status is %s, reason: %s" % (self.status, self.error_message))
@@ -365,7 +842,15 @@ class Toolchanger:
                                 self.active_tool.t_command_restore_axis)
         self.test_tool_selection(gcmd, restore_axis)
 
-    def initialize(self, select_tool=None):
+    def _resume_or_initialize(self, initialize):
+        detected_tool = self.get_stable_detected_tool()
+        resumable = self.checkpoint.take_resumable(detected_tool)
+        if resumable is not None:
+            self.initialize(resumable[0], from_checkpoint=True)
+        elif initialize:
+            self.initialize(detected_tool)
+
+    def initialize(self, select_tool=None, from_checkpoint=False):
         if self.status == STATUS_CHANGING:
             raise Exception('Cannot initialize while changing tools')
 
@@ -380,13 +865,20 @@ class Toolchanger:
 
         if should_run_initialize:
             self.status = STATUS_INITIALIZING
-            self.run_gcode('initialize_gcode', self.initialize_gcode, extra_context)
+            self._set_prestaged_tool(None)
+            if not from_checkpoint:
+                self.run_gcode('initialize_gcode', self.initialize_gcode,
+                               extra_context)
+            else:
+                # The restored position is recovered with the current state.
+                self._save_gcode_state()
 
         if select_tool or self.has_detection:
             self._configure_toolhead_for_tool(select_tool)
             if select_tool:
                 self.run_gcode('after_change_gcode', select_tool.after_change_gcode, extra_context)
-                self.gcode_transform.tool = select_tool
+                self.gcode_transform.set_tool(select_tool)
+                self._finish_fan_transfer(select_tool)
             if self.require_tool_present and self.active_tool is None:
                 raise self.gcode.error(
                     '%s failed to initialize, require_tool_present set and no tool present after initialization' % (
@@ -396,16 +888,17 @@ class Toolchanger:
             if self.status == STATUS_INITIALIZING:
                 self.status = STATUS_READY
                 self.tool_missing_helper.activate(self.active_tool)
-                self.gcode.respond_info('%s initialized, active %s' %
+                self.gcode.respond_info('%s %s, active %s' %
                                         (self.name,
+                                         'resumed from checkpoint' if from_checkpoint else 'initialized',
                                          self.active_tool.name if self.active_tool else None))
             else:
                 raise self.gcode.error('%s failed to initialize, error: %s' %
                                        (self.name, self.error_message))
 
     def select_tool(self, gcmd, tool, restore_axis):
-        if self.status == STATUS_UNINITALIZED and self.initialize_on == INIT_FIRST_USE:
-            self.initialize(self.detected_tool)
+        if self.status == STATUS_UNINITALIZED:
+            self._resume_or_initialize(self.initialize_on == INIT_FIRST_USE)
         if self.status != STATUS_READY:
             raise gcmd.error(
                 "Cannot select tool, toolchanger status is %s, reason: %s" % (self.status, self.error_message))
@@ -419,43 +912,50 @@ class Toolchanger:
         self.current_change_id = this_change_id
 
         try:
+            self.profiler.start(tool, self.active_tool)
+            self.standby.prepare_pickup(tool)
             self.ensure_homed(gcmd)
+            self.profiler.mark('home')
             self.status = STATUS_CHANGING
             self._save_state(restore_axis, tool)
+            self.profiler.mark('save_state')
 
             start_position = self._position_with_tool_offset(self.last_change_gcode_position, tool)
             extra_context = {
                 'dropoff_tool': self.active_tool.name if self.active_tool else None,
                 'pickup_tool': tool.name if tool else None,
+                'prestaged_tool': self.prestaged_tool.name if self.prestaged_tool else None,
                 'start_position': self._position_to_xyz(start_position, 'xyz'),
                 'restore_position': self._position_to_xyz(start_position, restore_axis),
             }
+            self.profiler.note('rp', extra_context['restore_position'])
 
             before_change_gcode = self.active_tool.before_change_gcode if self.active_tool else self.default_before_change_gcode
             self.run_gcode('before_change_gcode', before_change_gcode, extra_context)
             self._set_toolchange_transform()
+            self.profiler.mark('before_change')
 
             self.tool_missing_helper.deactivate()
             if self.active_tool:
                 self.run_gcode('tool.dropoff_gcode',
                                self.active_tool.dropoff_gcode, extra_context)
+                self._count_usage(self.active_tool, dropoffs=1)
+                self.profiler.mark('dropoff')
 
             self._configure_toolhead_for_tool(tool)
+            self.profiler.mark('configure')
             if tool is not None:
-                self.run_gcode('tool.pickup_gcode',
-                               tool.pickup_gcode, extra_context)
-                if self.has_detection and self.verify_tool_pickup:
-                    toolhead = self.printer.lookup_object('toolhead')
-                    reactor = self.printer.get_reactor()
-                    toolhead.wait_moves()
-                    # Wait some more to allow tool sensors to update
-                    reactor.pause(reactor.monotonic() + 0.2)
-                    self.validate_detected_tool(tool, respond_info=gcmd.respond_info, raise_error=gcmd.error)
+                self._pickup_tool(gcmd, tool, extra_context)
                 self.tool_missing_helper.activate(tool)
                 self.run_gcode('after_change_gcode',
                                tool.after_change_gcode, extra_context)
+                self.profiler.mark('after_change')
 
             self._restore_state_and_transform(tool)
+            self.profiler.mark('restore')
+            self.profiler.finish()
+            if tool is not None and tool == self.prestaged_tool:
+                self._set_prestaged_tool(None)
             self.status = STATUS_READY
             if tool:
                 gcmd.respond_info(
@@ -464,6 +964,7 @@ class Toolchanger:
                 gcmd.respond_info('Tool unselected')
             self.current_change_id = -1
         except gcmd.error:
+            self.profiler.cancel()
             if self.status == STATUS_ERROR:
                 # The error handling did happen, we can continue
                 pass
@@ -472,15 +973,28 @@ class Toolchanger:
                 self.current_change_id = -1
                 raise
 
-    def process_error(self, raise_error, message):
+    def process_error(self, raise_error, message, **journal_info):
+        self.detect_waiter.cancel_async()
         self.status = STATUS_ERROR
         self.error_message = message
         is_inside_toolchange = self.current_change_id != -1
+        # The active tool is the dropoff tool until the toolhead is
+        # configured for the pickup tool.
+        self._count_usage(self.active_tool, failures=1)
+        if is_inside_toolchange:
+            for key, value in journal_info.items():
+                self.profiler.note(key, value)
+            self.profiler.fail(message)
+        else:
+            self._journal_error(message, journal_info)
 
         self.current_change_id = -1
+        # The change is over, start the tool fan at the transferred speed,
+        # the recovery might not go through a tool change.
+        self._finish_fan_transfer(self.active_tool)
         if self.error_gcode:
             extra_context = {}
-            if is_inside_toolchange:
+            if is_inside_toolchange and self.last_change_gcode_position is not None:
                 start_position = self._position_with_tool_offset(self.last_change_gcode_position, self.last_change_pickup_tool)
                 extra_context = {
                     'start_position': self._position_to_xyz(start_position, "xyz"),
@@ -488,8 +1002,7 @@ class Toolchanger:
                     'pickup_tool': self.last_change_pickup_tool,
                 }
                 # Restore gcode state, but do not move. Prepare for error_gcode to run pause and capture the state for resume.
-                self.gcode.run_script_from_command(
-                    "RESTORE_GCODE_STATE NAME=_toolchange_state MOVE=0")
+                self._restore_gcode_state()
             self.run_gcode('error_gcode', self.error_gcode, extra_context)
             if is_inside_toolchange:
                 # HACKY HACKY HACKY
@@ -502,6 +1015,15 @@ class Toolchanger:
         if raise_error:
             raise raise_error(message)
 
+    def _journal_error(self, message, journal_info):
+        tool = self.active_tool
+        record = {'to': tool.name if tool else None, 'err': message,
+                  **journal_info}
+        def write(print_time):
+            record['pt'] = round(print_time, 3)
+            self.journal.write(record)
+        self.printer.lookup_object('toolhead').register_lookahead_callback(write)
+
     def _recover_position(self, gcmd, tool):
         start_position = self._position_with_tool_offset(self.last_change_gcode_position, tool)
         extra_context = {
@@ -533,38 +1055,69 @@ class Toolchanger:
                        self.active_tool.dropoff_gcode, extra_context)
         self.run_gcode('tool.pickup_gcode',
                        tool.pickup_gcode, extra_context)
+        self._count_usage(tool, dropoffs=1, pickups=1)
         self._restore_axis(gcode_position, restore_axis)
         gcmd.respond_info('Tool testing done')
 
     def lookup_tool(self, number):
-        return self.tools.get(number, None)
+        return self.registry.by_number.get(number, None)
+
+    def lookup_tool_by_name(self, name):
+        tool = self.registry.by_name.get(name)
+        if tool is None:
+            # Not a registered tool, fails with the usual unknown object error.
+            tool = self.printer.lookup_object(name)
+        return tool
 
     def get_selected_tool(self):
         return self.active_tool
 
+    def is_ready(self):
+        return self.status == STATUS_READY
+
+    def note_tool_offset_change(self, tool):
+        if self.gcode_transform.tool == tool:
+            self.gcode_transform.update_offset()
+
     def note_detect_change(self, tool, eventtime):
-        detected = None
-        detected_names = []
-        for tool in self.tools.values():
-            if tool.detect_state == DETECT_PRESENT:
-                detected = tool
-                detected_names.append(tool.name)
-        if len(detected_names) > 1:
-            detected = None
+        self.registry.note_detect(tool)
+        if self.detect_debounce:
+            # Wait for the pins to be stable for detect_debounce.
+            self.detect_pending = True
+            self.detect_edge_time = eventtime
+            self.reactor.update_timer(self.detect_timer,
+                                      eventtime + self.detect_debounce)
+            return
+        self._update_detected_tool(eventtime)
+
+    def _detect_event(self, eventtime):
+        self.detect_pending = False
+        self._update_detected_tool(self.detect_edge_time)
+        return self.reactor.NEVER
+
+    def get_stable_detected_tool(self):
+        """The detected tool, after waiting out a pending detect_debounce."""
+        if self.detect_pending:
+            self.reactor.pause(self.detect_edge_time + self.detect_debounce)
+        return self.detected_tool
+
+    def _update_detected_tool(self, eventtime):
+        detected = self.registry.get_detected()
+        if detected is self.detected_tool:
+            return
         self.detected_tool = detected
+        self.status_version += 1
         self.tool_missing_helper.note_tool_change(eventtime, detected)
+        self.detect_waiter.note_detect_change(detected, eventtime)
 
     def require_detected_tool(self, respond_info):
         if self.detected_tool is not None:
             return self.detected_tool
-        detected = None
-        detected_names = []
-        for tool in self.tools.values():
-            if tool.detect_state == DETECT_PRESENT:
-                detected = tool
-                detected_names.append(tool.name)
-        if len(detected_names) > 1:
-            respond_info("Multiple tools detected: %s" % (detected_names,))
+        detected = self.registry.get_detected()
+        present = self.registry.get_present()
+        if len(present) > 1:
+            respond_info("Multiple tools detected: %s" % (
+                sorted(t.name for t in present),))
         if detected is None:
             respond_info("No tool detected")
         return detected
@@ -575,40 +1128,170 @@ class Toolchanger:
             expected_name = expected.name if expected else "None"
             actual_name = actual.name if actual else "None"
             message = "Expected tool %s but active is %s" % (expected_name, actual_name)
-            self.process_error(raise_error, message)
+            self.process_error(raise_error, message, v=False)
 
     def cmd_VERIFY_TOOL_DETECTED(self, gcmd):
         self._ensure_toolchanger_ready(gcmd)
         expected = self.gcmd_tool(gcmd, self.active_tool)
         if not self.has_detection:
             return
-        toolhead = self.printer.lookup_object('toolhead')
-        reactor = self.printer.get_reactor()
         if gcmd.get_int("ASYNC", 0) == 1:
             if self.error_gcode is None:
                 raise gcmd.error("VERIFY_TOOL_DETECTED ASYNC=1 needs error_gcode to be defined")
-            def timer_handler(reactor_time) :
-                self.validate_detected_tool(expected, respond_info=gcmd.respond_info, raise_error=None)
-                return reactor.NEVER
-            if self.validate_tool_timer:
-                reactor.unregister_timer(self.validate_tool_timer)
-            self.validate_tool_timer = toolhead.register_lookahead_callback(lambda print_time:
-                                                                            reactor.register_timer(timer_handler, reactor.monotonic() + 0.2 + max(0.0, print_time - toolhead.mcu.estimated_print_time(reactor.monotonic())) ))
+            self.detect_waiter.verify_async(
+                expected, lambda tool: self.validate_detected_tool(
+                    tool, respond_info=gcmd.respond_info, raise_error=None))
         else:
-            toolhead.wait_moves()
-            # Wait some more to allow tool sensors to update
-            reactor.pause(reactor.monotonic() + 0.2)
-            self.validate_detected_tool(expected, respond_info=gcmd.respond_info, raise_error=gcmd.error)
+            self.wait_detected_tool(gcmd, expected)
+
+    def _pickup_tool(self, gcmd, tool, extra_context):
+        """Runs the pickup gcode and verifies the tool is detected.
+
+        A failed pickup is retried up to pickup_retries times, by running
+        the dropoff and pickup gcode again, before failing. Verification
+        failures inside the pickup gcode are deferred to the retry."""
+        verify = self.has_detection and self.verify_tool_pickup
+        retries = tool.pickup_retries
+        if not verify or self.verify_tool_pickup_async:
+            retries = 0
+        speed_param = 'params_path_speed'
+        restore_speed = None
+        context = extra_context
+        try:
+            for attempt in range(retries + 1):
+                if attempt > 0:
+                    detected = self.detected_tool
+                    message = ("Pickup of %s failed, detected %s,"
+                               " retry %d of %d" % (
+                                   tool.name, detected.name if detected else None,
+                                   attempt, retries))
+                    logging.info("Toolchanger: %s", message)
+                    gcmd.respond_info(message)
+                    self.profiler.note('rt', attempt)
+                    self._count_usage(tool, failures=1)
+                    if (restore_speed is None and speed_param in tool.params
+                            and tool.pickup_retry_path_speed is not None):
+                        restore_speed = (tool.params[speed_param],
+                                         speed_param in tool.original_params)
+                        tool.set_parameter(speed_param,
+                                           tool.pickup_retry_path_speed)
+                    context = {**extra_context, 'dropoff_tool': tool.name}
+                    self.run_gcode('tool.dropoff_gcode', tool.dropoff_gcode,
+                                   context)
+                    self._count_usage(tool, dropoffs=1)
+                self.retrying_pickup = tool if attempt < retries else None
+                self._count_usage(tool, pickups=1)
+                self.run_gcode('tool.pickup_gcode', tool.pickup_gcode,
+                               context)
+                if attempt == 0:
+                    self.profiler.mark('pickup')
+                if not verify:
+                    return
+                if self.verify_tool_pickup_async:
+                    self.detect_waiter.verify_async(
+                        tool, self._handle_async_verify_failed)
+                    self.profiler.note('v', 'async')
+                    break
+                # Only the detection after the pickup decides a retry, a
+                # tool detected late along the path is picked up.
+                self.wait_detected_tool(gcmd, tool)
+                if self.detected_tool is tool:
+                    self.profiler.note('v', True)
+                    break
+        finally:
+            self.retrying_pickup = None
+            if restore_speed is not None:
+                value, was_modified = restore_speed
+                if was_modified:
+                    tool.set_parameter(speed_param, value)
+                else:
+                    tool.reset_parameter(speed_param)
+        self.profiler.mark('verify')
+
+    def wait_detected_tool(self, gcmd, expected):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.wait_moves()
+        self.detect_waiter.wait_for(expected)
+        if expected is self.retrying_pickup and self.detected_tool is not expected:
+            # Checked again once the pickup gcode is done.
+            return
+        self.validate_detected_tool(expected, respond_info=gcmd.respond_info, raise_error=gcmd.error)
+
+    cmd_TOOL_PATH_help = "Move along the tool pickup or dropoff path"
+    def cmd_TOOL_PATH(self, gcmd):
+        tool = self.gcmd_tool(gcmd, self.active_tool)
+        if tool is None:
+            raise gcmd.error("TOOL_PATH: no tool selected")
+        path_name = gcmd.get('PATH').lower()
+        path = tool.params.get('params_%s_path' % (path_name,))
+        if not isinstance(path, (list, tuple)):
+            raise gcmd.error("TOOL_PATH: %s has no params_%s_path list" % (
+                tool.name, path_name))
+        if not self.gcode_move.get_status()['absolute_coordinates']:
+            raise gcmd.error("TOOL_PATH requires absolute coordinates (G90)")
+        origin = [gcmd.get_float(axis, tool.params.get(
+                      'params_park_' + axis.lower()))
+                  for axis in 'XYZ']
+        speed = gcmd.get_float('SPEED', tool.params.get('params_path_speed'),
+                               above=0.)
+        if speed is None:
+            raise gcmd.error("TOOL_PATH: %s is missing params_path_speed"
+                             % (tool.name,))
+        rounding = gcmd.get_float('D', 0., minval=0.)
+        move = self.gcode_move.cmd_G1
+        if rounding > 0.:
+            rounded_path = self.printer.lookup_object('rounded_path', None)
+            if rounded_path is None:
+                raise gcmd.error("TOOL_PATH D= requires [rounded_path]")
+            move = rounded_path.cmd_ROUNDED_G0
+        # Build all the moves first, to not stop halfway on a bad path.
+        moves = []
+        try:
+            for i, waypoint in enumerate(path):
+                params = {'F': speed * float(waypoint.get('f', 1.))}
+                for axis_index, axis in enumerate('xyz'):
+                    if axis not in waypoint:
+                        continue
+                    if origin[axis_index] is None:
+                        raise gcmd.error("TOOL_PATH: %s is missing params_park_%s"
+                                         % (tool.name, axis))
+                    params[axis.upper()] = (float(origin[axis_index])
+                                            + float(waypoint[axis]))
+                verify = bool(waypoint.get('verify', False))
+                if rounding > 0.:
+                    last = i == len(path) - 1
+                    params['D'] = 0. if verify or last else rounding
+                moves.append((self.gcode.create_gcode_command(
+                    "G0", "G0", params), verify))
+        except (AttributeError, TypeError, ValueError):
+            raise gcmd.error("TOOL_PATH: invalid waypoint in %s params_%s_path"
+                             % (tool.name, path_name))
+        for move_gcmd, verify in moves:
+            move(move_gcmd)
+            if verify and self.has_detection:
+                if self.verify_tool_pickup_async:
+                    self.detect_waiter.verify_async(
+                        tool, self._handle_async_verify_failed)
+                else:
+                    self.wait_detected_tool(gcmd, tool)
+
+    def _handle_async_verify_failed(self, expected):
+        self.validate_detected_tool(expected,
+                                    respond_info=self.gcode.respond_info,
+                                    raise_error=None)
 
     def _configure_toolhead_for_tool(self, tool):
         if self.active_tool:
             self.active_tool.deactivate()
+        self.standby.note_tool_change(self.active_tool, tool)
         self.active_tool = tool
         if self.tool_probe_endstop:
             probe = tool.probe if tool else None
             self.tool_probe_endstop.set_active_probe(probe)
         if self.active_tool:
             self.active_tool.activate()
+        self.extruder_switcher.apply()
+        self.motion_switcher.apply()
 
     def _position_to_xyz(self, position, axis):
         if len(position) < 3:
@@ -653,41 +1336,93 @@ class Toolchanger:
         """
         gcode_status = self.gcode_move.get_status()
 
-        self.gcode.run_script_from_command("SAVE_GCODE_STATE NAME=_toolchange_state")
+        self._save_gcode_state()
         self.last_change_pickup_tool = tool
         self.last_change_gcode_position = list(gcode_status['gcode_position'])
         self.last_change_gcode_offset = gcode_status['homing_origin']
         self.last_change_restore_axis = restore_axis
 
     def _set_toolchange_transform(self):
-        self.gcode_transform.tool = None
+        self.gcode_transform.set_tool(None)
         self.gcode_move.reset_last_position()
-        self.gcode.run_script_from_command("SET_GCODE_OFFSET X=0.0 Y=0.0 Z=0.0")
+        self._zero_gcode_offset()
 
     def _restore_state_and_transform(self, tool):
-        self.gcode_transform.tool = tool
+        self.gcode_transform.set_tool(tool)
         self.gcode_move.reset_last_position()
-        self.gcode.run_script_from_command("RESTORE_GCODE_STATE NAME=_toolchange_state MOVE=0")
+        self._restore_gcode_state()
         self.last_change_gcode_offset = None
         if self.last_change_restore_axis:
             self._restore_axis(self.last_change_gcode_position, self.last_change_restore_axis)
-            self.gcode.run_script_from_command("RESTORE_GCODE_STATE NAME=_toolchange_state MOVE=0")
+            self._restore_gcode_state()
+        self._finish_fan_transfer(tool)
+
+    def _count_usage(self, tool, **amounts):
+        # Counted by the toolchanger the tool belongs to, like its status.
+        if tool is not None:
+            tool.toolchanger.usage.add(tool, **amounts)
+
+    def _finish_fan_transfer(self, tool):
+        if tool is not None and tool.fan:
+            tool.toolchanger.fan_switcher.finish_transfer()
 
     def _restore_axis(self, position, axis):
         pos = self._position_with_tool_offset(position, None)
-        self.gcode.run_script_from_command("G90")
+        if self.direct_gcode_state:
+            self.gcode_move.absolute_coord = True
+        else:
+            self.gcode.run_script_from_command("G90")
         self.gcode_move.cmd_G1(self.gcode.create_gcode_command("G0", "G0", self._position_to_xyz(pos, axis)))
 
-    def run_gcode(self, name, template, extra_context):
-        curtime = self.printer.get_reactor().monotonic()
-        context = {
-            **template.create_template_context(),
-            'tool': self.active_tool.get_status(
-                curtime) if self.active_tool else {},
-            'toolchanger': self.get_status(curtime),
-            **extra_context,
+    # Same as SAVE_GCODE_STATE, RESTORE_GCODE_STATE MOVE=0 and
+    # SET_GCODE_OFFSET X=0 Y=0 Z=0, without parsing the gcode.
+    def _save_gcode_state(self):
+        if not self.direct_gcode_state:
+            self.gcode.run_script_from_command("SAVE_GCODE_STATE NAME=_toolchange_state")
+            return
+        gcode_move = self.gcode_move
+        gcode_move.saved_states['_toolchange_state'] = {
+            'absolute_coord': gcode_move.absolute_coord,
+            'absolute_extrude': gcode_move.absolute_extrude,
+            'base_position': list(gcode_move.base_position),
+            'last_position': list(gcode_move.last_position),
+            'homing_position': list(gcode_move.homing_position),
+            'speed': gcode_move.speed,
+            'speed_factor': gcode_move.speed_factor,
+            'extrude_factor': gcode_move.extrude_factor,
         }
-        template.run_gcode_from_command(context)
+
+    def _restore_gcode_state(self):
+        if not self.direct_gcode_state:
+            self.gcode.run_script_from_command("RESTORE_GCODE_STATE NAME=_toolchange_state MOVE=0")
+            return
+        gcode_move = self.gcode_move
+        state = gcode_move.saved_states.get('_toolchange_state')
+        if state is None:
+            raise self.gcode.error("Unknown g-code state: _toolchange_state")
+        gcode_move.absolute_coord = state['absolute_coord']
+        gcode_move.absolute_extrude = state['absolute_extrude']
+        gcode_move.base_position = list(state['base_position'])
+        gcode_move.homing_position = list(state['homing_position'])
+        gcode_move.speed = state['speed']
+        gcode_move.speed_factor = state['speed_factor']
+        gcode_move.extrude_factor = state['extrude_factor']
+        # Keep the relative E position
+        e_diff = gcode_move.last_position[3] - state['last_position'][3]
+        gcode_move.base_position[3] += e_diff
+
+    def _zero_gcode_offset(self):
+        if not self.direct_gcode_state:
+            self.gcode.run_script_from_command("SET_GCODE_OFFSET X=0.0 Y=0.0 Z=0.0")
+            return
+        gcode_move = self.gcode_move
+        for i in range(3):
+            gcode_move.base_position[i] -= gcode_move.homing_position[i]
+            gcode_move.homing_position[i] = 0.
+
+    def run_gcode(self, name, template, extra_context, tool=None):
+        script = self.templates.render(self, template, extra_context, tool)
+        self.gcode.run_script_from_command(script)
 
     def cmd_SET_TOOL_PARAMETER(self, gcmd):
         tool = self._get_tool_from_gcmd(gcmd)
@@ -707,6 +1442,42 @@ class Toolchanger:
             raise gcmd.error('Tool does not have parameter %s' % (name))
         tool.save_parameter(name)
 
+    cmd_TOOLCHANGE_STATS_help = "Report or reset per phase tool change timing"
+    def cmd_TOOLCHANGE_STATS(self, gcmd):
+        tool = self.gcmd_tool(gcmd, default=None)
+        tool_name = tool.name if tool else None
+        if gcmd.get_int('RESET', 0) == 1:
+            self.profiler.reset(tool_name)
+            gcmd.respond_info('Tool change stats reset')
+            return
+        stats = self.profiler.get_stats()
+        if tool_name is not None:
+            stats = {tool_name: stats.get(tool_name, {})}
+        journal_report = self.journal.get_loss_report()
+        if not any(stats.values()):
+            gcmd.respond_info('\n'.join(filter(None, [
+                'No tool change stats recorded', journal_report])))
+            return
+        lines = []
+        for name, phases in stats.items():
+            lines.append('%s: %d changes' % (
+                name, phases['total']['count'] if 'total' in phases else 0))
+            for phase in TOOLCHANGE_PHASES + ['total']:
+                if phase not in phases:
+                    continue
+                p = phases[phase]
+                lines.append('  %-13s p50 %.3fs p95 %.3fs max %.3fs | print p50 %.3fs p95 %.3fs max %.3fs' % (
+                    phase, p['p50'], p['p95'], p['max'],
+                    p['print_p50'], p['print_p95'], p['print_max']))
+            tool = self.registry.by_name.get(name)
+            settle_time = self.detect_waiter.get_settle_time(tool)
+            if tool is not None and settle_time is not None:
+                lines.append('  detect settle max %.3fs, timeout %.3fs' % (
+                    settle_time, self.detect_waiter.get_timeout(tool)))
+        if journal_report:
+            lines.append(journal_report)
+        gcmd.respond_info('\n'.join(lines))
+
     def cmd_ADJUST_Z_AFTER_TOOL_NOZZLE_HOME(self, gcmd):
         tool = self.active_tool
         if not tool:
@@ -771,7 +1542,7 @@ class Toolchanger:
             tool_number = gcmd.get_int(extra_number_arg, None)
         tool = None
         if tool_name:
-            tool = self.printer.lookup_object(tool_name)
+            tool = self.lookup_tool_by_name(tool_name)
         if tool_number is not None:
             tool = self.lookup_tool(tool_number)
             if not tool:
@@ -786,7 +1557,153 @@ class Toolchanger:
         if self.status not in [STATUS_READY, STATUS_CHANGING]:
             raise gcmd.error(f"VERIFY_TOOL_DETECTED: toolchanger not ready: status = {self.status}")
 
+class ExtruderSwitcher:
+    """Activates the tool extruder and syncs the tool extruder_stepper.
+
+    Changes from the deactivated and activated tool are collected and
+    applied together, skipping the ones already in place, like a tool
+    re-selected with the same extruder_stepper. Klipper flushes the step
+    generation on every extruder activation and stepper sync, and a flush
+    cannot run from a lookahead callback, so each change that is not
+    skipped still flushes."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.extruder = None
+        # Extruder stepper -> True to sync to the active extruder, False to unsync
+        self.syncs = {}
+
+    def deactivate(self, tool):
+        if tool.extruder_stepper:
+            self.syncs[tool.extruder_stepper] = False
+
+    def activate(self, tool):
+        if tool.extruder:
+            self.extruder = tool.extruder
+        if tool.extruder_stepper:
+            self.syncs[tool.extruder_stepper] = True
+
+    def apply(self):
+        extruder, self.extruder = self.extruder, None
+        syncs, self.syncs = self.syncs, {}
+        toolhead = self.printer.lookup_object('toolhead')
+        if extruder is not None and extruder is not toolhead.get_extruder():
+            extruder.cmd_ACTIVATE_EXTRUDER(self.gcode.create_gcode_command(
+                "ACTIVATE_EXTRUDER", "ACTIVATE_EXTRUDER",
+                {'EXTRUDER': extruder.name}))
+        hotend_extruder = toolhead.get_extruder().name
+        for extruder_stepper, sync in syncs.items():
+            motion_queue = hotend_extruder if sync and hotend_extruder else None
+            stepper = extruder_stepper.extruder_stepper
+            if stepper.motion_queue != motion_queue:
+                stepper.sync_to_extruder(motion_queue)
+
+class MotionProfileSwitcher:
+    """Applies the motion profile of the selected tool.
+
+    The velocity limits, pressure advance and input shaper settings of the
+    tool are applied together, after the extruder switch. Settings already
+    in effect are skipped, SET_INPUT_SHAPER flushes the step generation.
+    The live values are kept when a tool first changes a setting, and
+    restored when the setting is no longer set by the selected tool. A
+    setting changed during the print, after the profile applied it, is
+    left as is."""
+    def __init__(self, toolchanger, config):
+        self.printer = config.get_printer()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.tool = None
+        self.pending = False
+        self.original = {}  # (option, extruder stepper) -> value
+        self.applied = {}  # (option, extruder stepper) -> value
+
+    def activate(self, tool):
+        self.tool = tool
+        self.pending = True
+
+    def deactivate(self, tool):
+        self.tool = None
+        self.pending = True
+
+    def _get_settings(self, tool):
+        settings = {}
+        if tool is None:
+            return settings
+        stepper = tool.get_pressure_advance_stepper()
+        for option, value in tool.motion_profile.items():
+            target = MOTION_PROFILE_OPTIONS[option][0]
+            settings[(option, stepper if target == 'extruder' else None)] = value
+        return settings
+
+    def _get_current(self, key, eventtime):
+        option, stepper = key
+        target, field, _ = MOTION_PROFILE_OPTIONS[option]
+        if target == 'toolhead':
+            status = self.printer.lookup_object('toolhead').get_status(eventtime)
+            return status.get(field)
+        if target == 'extruder':
+            return stepper.get_status(eventtime).get(field)
+        # The input shaper does not report its settings, read them from
+        # the shaper of the axis.
+        name, axis = field.rsplit('_', 1)
+        input_shaper = self.printer.lookup_object('input_shaper')
+        for shaper in getattr(input_shaper, 'shapers', ()):
+            if getattr(shaper, 'axis', None) == axis:
+                return getattr(shaper.params, name, None)
+        return None
+
+    def apply(self):
+        if not self.pending:
+            return
+        self.pending = False
+        eventtime = self.printer.get_reactor().monotonic()
+        wanted = self._get_settings(self.tool)
+        updates = {}
+        for key in list(self.applied):
+            if key in wanted:
+                continue
+            applied = self.applied.pop(key)
+            original = self.original.pop(key)
+            if self._get_current(key, eventtime) == applied:
+                updates[key] = original
+        for key, value in wanted.items():
+            if key not in self.applied:
+                self.original[key] = self._get_current(key, eventtime)
+            self.applied[key] = updates[key] = value
+        # Group the changes by target, to apply each with a single call.
+        toolhead_limits = {}
+        commands = {}  # extruder stepper or input shaper -> params
+        for key, value in updates.items():
+            if value is None or self._get_current(key, eventtime) == value:
+                continue
+            option, stepper = key
+            target, field, param = MOTION_PROFILE_OPTIONS[option]
+            if target == 'toolhead':
+                toolhead_limits[field] = value
+            else:
+                obj = stepper if target == 'extruder' else 'input_shaper'
+                commands.setdefault(obj, {})[param] = str(value)
+        if toolhead_limits:
+            toolhead = self.printer.lookup_object('toolhead')
+            toolhead.set_max_velocities(
+                toolhead_limits.get('max_velocity'),
+                toolhead_limits.get('max_accel'),
+                toolhead_limits.get('square_corner_velocity'), None)
+        for obj, params in commands.items():
+            if obj == 'input_shaper':
+                input_shaper = self.printer.lookup_object('input_shaper')
+                input_shaper.cmd_SET_INPUT_SHAPER(
+                    self.gcode.create_gcode_command(
+                        "SET_INPUT_SHAPER", "SET_INPUT_SHAPER", params))
+            else:
+                obj.cmd_SET_PRESSURE_ADVANCE(self.gcode.create_gcode_command(
+                    "SET_PRESSURE_ADVANCE", "SET_PRESSURE_ADVANCE", params))
+
 class FanSwitcher:
+    """Transfers the part cooling fan speed to the selected tool's fan.
+
+    Speeds are set through the fan objects, queued at the print time of
+    the preceding moves. The new fan is started once the tool change is
+    done, when the new tool starts printing."""
     def __init__(self, toolchanger, config):
         self.toolchanger = toolchanger
         self.printer = config.get_printer()
@@ -814,15 +1731,18 @@ class FanSwitcher:
         speed_to_set = self.pending_speed
         if self.active_fan:
             speed_to_set = self.active_fan.get_status(0)['speed']
-            self.gcode.run_script_from_command("SET_FAN_SPEED FAN='%s' SPEED=%s" % (self.active_fan.fan_name, 0.0))
+            self._set_fan_speed(self.active_fan, 0.0)
         self.active_fan = fan
-        if speed_to_set is not None:
-            if self.active_fan:
-                self.pending_speed = None
-                self.gcode.run_script_from_command(
-                    "SET_FAN_SPEED FAN='%s' SPEED=%s" % (self.active_fan.fan_name, speed_to_set))
-            else:
-                self.pending_speed = speed_to_set
+        self.pending_speed = speed_to_set
+
+    def finish_transfer(self):
+        """Starts the active fan at the transferred speed."""
+        if self.active_fan and self.pending_speed is not None:
+            self._set_fan_speed(self.active_fan, self.pending_speed)
+            self.pending_speed = None
+
+    def _set_fan_speed(self, fan, speed):
+        fan.fan.set_speed_from_command(speed)
 
     def cmd_M106(self, gcmd):
         tool = self.toolchanger.gcmd_tool(gcmd, default=self.toolchanger.active_tool, extra_number_arg='P')
@@ -835,27 +1755,58 @@ class FanSwitcher:
 
     def set_speed(self, speed, tool):
         if tool and tool.fan:
-            self.gcode.run_script_from_command("SET_FAN_SPEED FAN='%s' SPEED=%s" % (tool.fan.fan_name, speed))
+            if tool.fan == self.active_fan:
+                self.pending_speed = None
+            self._set_fan_speed(tool.fan, speed)
         else:
             self.pending_speed = speed
 
 # Helper class for applying tool offset
 class ToolGcodeTransform:
+    """Applies the active tool offset to gcode moves.
+
+    The offset is cached on tool change or offset parameter change, moves
+    reuse a single position list and skip the math when the offset is
+    zero."""
     def __init__(self):
         self.next_transform = None
         self.tool = None
+        self.x_offset = self.y_offset = self.z_offset = 0.
+        self.has_offset = False
+        self.position = []
+
+    def set_tool(self, tool):
+        self.tool = tool
+        self.update_offset()
+
+    def update_offset(self):
+        if self.tool:
+            self.x_offset, self.y_offset, self.z_offset = self.tool.get_offset()
+        else:
+            self.x_offset = self.y_offset = self.z_offset = 0.
+        self.has_offset = bool(self.x_offset or self.y_offset
+                               or self.z_offset)
 
     def move(self, newpos, speed):
-        if not self.tool:
+        if not self.has_offset:
             return self.next_transform.move(newpos, speed)
-        transformed_pos = [newpos[0] + self.tool.gcode_x_offset, newpos[1] + self.tool.gcode_y_offset, newpos[2] + self.tool.gcode_z_offset] + newpos[3:]
-        return self.next_transform.move(transformed_pos, speed)
+        # The next transform copies the position, same as with gcode_move.
+        pos = self.position
+        pos[:] = newpos
+        pos[0] += self.x_offset
+        pos[1] += self.y_offset
+        pos[2] += self.z_offset
+        return self.next_transform.move(pos, speed)
 
     def get_position(self):
         base_pos = self.next_transform.get_position()
-        if not self.tool:
+        if not self.has_offset:
             return base_pos
-        return [base_pos[0] - self.tool.gcode_x_offset, base_pos[1] - self.tool.gcode_y_offset, base_pos[2] - self.tool.gcode_z_offset] + base_pos[3:]
+        pos = list(base_pos)
+        pos[0] -= self.x_offset
+        pos[1] -= self.y_offset
+        pos[2] -= self.z_offset
+        return pos
 
 def get_params_dict(config):
     result = {}
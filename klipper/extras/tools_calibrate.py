@@ -3,7 +3,10 @@
 # This module has been adapted from code written by Kevin O'Connor <kevin@koconnor.net> and Martin Hierholzer <martin@hierholzer.info>
 # Sourced from https://github.com/ben5459/Klipper_ToolChanger/blob/master/probe_multi_axis.py
 
-import logging
+import ast, logging
+
+# Tool parameters applied as a single float, see Tool._apply_param.
+TOOL_OFFSET_PARAMETERS = ('gcode_x_offset', 'gcode_y_offset', 'gcode_z_offset')
 
 direction_types = {'x+': [0, +1], 'x-': [0, -1], 'y+': [1, +1], 'y-': [1, -1],
                    'z+': [2, +1], 'z-': [2, -1]}
@@ -136,14 +139,31 @@ class ToolsCalibrate:
 
     def cmd_TOOL_CALIBRATE_SAVE_TOOL_OFFSET(self, gcmd):
         if not self.last_result:
-            gcmd.error(
+            raise gcmd.error(
                 "No offset result, please run TOOL_CALIBRATE_TOOL_OFFSET first")
-            return
         section_name = gcmd.get("SECTION")
         param_name = gcmd.get("ATTRIBUTE")
         template = gcmd.get("VALUE", "{x:0.6f}, {y:0.6f}, {z:0.6f}")
         value = template.format(x=self.last_result[0], y=self.last_result[1],
                                 z=self.last_result[2])
+        tool = self.printer.lookup_object(section_name, None)
+        store = getattr(getattr(tool, 'toolchanger', None),
+                        'parameter_store', None)
+        if store is not None and store.is_enabled():
+            # Apply to the tool right away and keep in the parameter store.
+            try:
+                value = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                raise gcmd.error("VALUE '%s' is not a valid literal" % (value,))
+            if param_name in TOOL_OFFSET_PARAMETERS and (
+                    isinstance(value, bool)
+                    or not isinstance(value, (int, float))):
+                raise gcmd.error("ATTRIBUTE %s needs a single number VALUE, "
+                                 "eg VALUE={x:0.6f}, got '%s'"
+                                 % (param_name, value))
+            tool.set_parameter(param_name, value)
+            tool.save_parameter(param_name)
+            return
         configfile = self.printer.lookup_object('configfile')
         configfile.set(section_name, param_name, value)
 
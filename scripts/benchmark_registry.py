@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# Scaling benchmark for the toolchanger tool registry
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+"""Registers 8..1024 synthetic tools and times registration, lookups and
+detection changes. The time per operation should stay flat as the number
+of tools grows.
+
+The registry contents are checked after each step, and registering all the
+tools of a case must take less than --max-register-ms. Exits with an error
+on a failed check.
+
+Needs a Klipper checkout, the toolchanger modules are loaded from this repo:
+  python3 scripts/benchmark_registry.py --klipper ~/klipper
+"""
+import argparse, sys, time
+import toolchanger_env
+
+class BenchTool:
+    def __init__(self, toolchanger, number):
+        self.name = 'tool T%d' % (number,)
+        self.tool_number = number
+        self.detect_state = toolchanger.DETECT_ABSENT
+        self.probe = None
+
+def timed(func, count):
+    start = time.perf_counter()
+    func()
+    return (time.perf_counter() - start) / count * 1e6
+
+def check_indexes(registry, tools):
+    tools = sorted(tools, key=lambda t: t.tool_number)
+    if registry.by_name != {t.name: t for t in tools}:
+        raise Exception("Wrong tools by name")
+    if registry.by_number != {t.tool_number: t for t in tools}:
+        raise Exception("Wrong tools by number")
+    if registry.numbers != [t.tool_number for t in tools]:
+        raise Exception("Tool numbers out of order")
+    if registry.names != [t.name for t in tools]:
+        raise Exception("Tool names out of order")
+
+def run_case(toolchanger, tool_count, lookups, max_register_ms):
+    registry = toolchanger.ToolRegistry()
+    tools = [BenchTool(toolchanger, i) for i in range(tool_count)]
+    def register():
+        for tool in tools:
+            registry.register(tool)
+            registry.assign(tool, tool.tool_number, -1)
+    register_us = timed(register, tool_count)
+    check_indexes(registry, tools)
+    register_ms = register_us * tool_count / 1000.
+    if register_ms > max_register_ms:
+        raise Exception("Registering %d tools took %.1f ms, over %.1f ms" % (
+            tool_count, register_ms, max_register_ms))
+    numbers = [i % tool_count for i in range(lookups)]
+    names = [tools[n].name for n in numbers]
+    def by_number():
+        get = registry.by_number.get
+        for n in numbers:
+            get(n)
+    def by_name():
+        get = registry.by_name.get
+        for n in names:
+            get(n)
+    number_us = timed(by_number, lookups)
+    name_us = timed(by_name, lookups)
+    # Simulate a tool change: old tool undetected, new tool detected.
+    def detect():
+        prev = None
+        for n in numbers:
+            tool = tools[n]
+            if prev is not None:
+                prev.detect_state = toolchanger.DETECT_ABSENT
+                registry.note_detect(prev)
+            tool.detect_state = toolchanger.DETECT_PRESENT
+            registry.note_detect(tool)
+            if registry.get_detected() is not tool:
+                raise Exception("Wrong tool detected")
+            prev = tool
+    detect_us = timed(detect, lookups)
+    # Renumber every tool to a new number, in the order of Tool.assign_tool.
+    def reassign():
+        for tool in tools:
+            prev_number = tool.tool_number
+            tool.tool_number += tool_count
+            registry.assign(tool, tool.tool_number, prev_number)
+    reassign_us = timed(reassign, tool_count)
+    check_indexes(registry, tools)
+    if registry.get_present() != [tools[numbers[-1]]]:
+        raise Exception("Wrong present tools after renumbering")
+    print("%6d %12.3f %12.3f %12.3f %12.3f %12.3f" % (
+        tool_count, register_us, number_us, name_us, detect_us, reassign_us))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--klipper', default=toolchanger_env.DEFAULT_KLIPPER_PATH,
+                        help="Klipper checkout path")
+    parser.add_argument('-n', '--lookups', type=int, default=200000,
+                        help="number of lookups per case")
+    parser.add_argument('--tools', type=int, nargs='*',
+                        default=[8, 64, 256, 1024],
+                        help="tool counts to test")
+    parser.add_argument('--max-register-ms', type=float, default=100.,
+                        help="max time to register all the tools of a case")
+    args = parser.parse_args()
+    toolchanger = toolchanger_env.load_extras_module(args.klipper,
+                                                     'toolchanger')
+    print("Microseconds per operation, Python %s" % (
+        sys.version.split()[0],))
+    print("%6s %12s %12s %12s %12s %12s" % (
+        'tools', 'register', 'by number', 'by name', 'detect', 'reassign'))
+    try:
+        for tool_count in args.tools:
+            run_case(toolchanger, tool_count, args.lookups,
+                     args.max_register_ms)
+    except Exception as e:
+        sys.exit("FAILED: %s" % (e,))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Throughput benchmark for the toolchanger gcode move transform
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+"""Pushes synthetic moves through ToolGcodeTransform and reports moves/sec.
+
+Needs a Klipper checkout, the toolchanger modules are loaded from this repo:
+  python3 scripts/benchmark_transform.py --klipper ~/klipper
+"""
+import argparse, sys, time
+import toolchanger_env
+
+class BenchTool:
+    def __init__(self, x, y, z):
+        self.gcode_x_offset = x
+        self.gcode_y_offset = y
+        self.gcode_z_offset = z
+    def get_offset(self):
+        return [self.gcode_x_offset, self.gcode_y_offset, self.gcode_z_offset]
+
+class SinkTransform:
+    """Stands in for the toolhead, copies the position like Move does."""
+    def __init__(self):
+        self.position = [0., 0., 0., 0.]
+        self.count = 0
+    def move(self, newpos, speed):
+        self.position = tuple(newpos)
+        self.count += 1
+    def get_position(self):
+        return list(self.position)
+
+def make_moves(count):
+    # A zig-zag of 1000 distinct positions, reused to keep memory flat.
+    positions = [[float(i % 200), float(i % 150), 0.2 + (i // 500) * 0.2,
+                  i * 0.01] for i in range(1000)]
+    for i in range(count):
+        yield positions[i % 1000]
+
+def run_case(toolchanger, name, tool, count, chain):
+    sink = SinkTransform()
+    transform = sink
+    transforms = []
+    for _ in range(chain):
+        t = toolchanger.ToolGcodeTransform()
+        t.next_transform = transform
+        t.set_tool(tool)
+        transforms.append(t)
+        transform = t
+    moves = list(make_moves(min(count, 1000)))
+    move = transform.move
+    start = time.perf_counter()
+    done = 0
+    while done < count:
+        for pos in moves:
+            move(pos, 100.)
+        done += len(moves)
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    get_position = transform.get_position
+    positions = count // 10
+    for _ in range(positions):
+        get_position()
+    pos_elapsed = time.perf_counter() - start
+    print("%-16s %12.0f moves/s %12.0f get_position/s" % (
+        name, done / elapsed, positions / pos_elapsed))
+    return sink.count
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--klipper', default=toolchanger_env.DEFAULT_KLIPPER_PATH,
+                        help="Klipper checkout path")
+    parser.add_argument('-n', '--moves', type=int, default=3000000,
+                        help="number of moves per case")
+    parser.add_argument('--chain', type=int, default=1,
+                        help="number of chained transforms")
+    args = parser.parse_args()
+    toolchanger = toolchanger_env.load_extras_module(args.klipper,
+                                                     'toolchanger')
+    print("%d moves per case, %d chained transforms, Python %s" % (
+        args.moves, args.chain, sys.version.split()[0]))
+    run_case(toolchanger, 'no tool', None, args.moves, args.chain)
+    run_case(toolchanger, 'zero offset', BenchTool(0., 0., 0.),
+             args.moves, args.chain)
+    run_case(toolchanger, 'offset', BenchTool(0.5, -0.2, 0.1),
+             args.moves, args.chain)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+; Tool changes with moves in between, T0 is mounted at start.
+INITIALIZE_TOOLCHANGER
+G90
+G1 X100 Y100 Z10 F6000
+T1
+G1 X120 Y100 F6000
+T2
+G1 X140 Y100 F6000
+T0
+G1 X100 Y120 F6000
+T1
+T0
+TOOLCHANGE_STATS
@@ -0,0 +1,19 @@
+; Error injection, T0 is mounted at start.
+INITIALIZE_TOOLCHANGER
+!printing on
+T1
+; Tool bounces off and back within tool_missing_delay, ignored
+!detach tool T1
+!wait 0.5
+!attach tool T1
+!wait 3
+; Tool falls off, errors out after tool_missing_delay
+!detach tool T1
+!wait 3
+; Recover with T0, pickup of T2 is not detected
+!attach tool T1
+INITIALIZE_TOOLCHANGER
+T0
+!fail_pickup tool T2
+T2
+!printing off
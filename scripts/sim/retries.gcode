@@ -0,0 +1,10 @@
+; Pickup retries, T0 is mounted at start.
+INITIALIZE_TOOLCHANGER
+; Detected after the pickup path verify but before the end of the
+; pickup, not retried
+!late_pickup tool T1
+T1
+; Not detected, retried once
+!fail_pickup tool T2
+T2
+T0
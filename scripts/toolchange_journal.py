@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Summarize the toolchanger journal
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+"""Prints per tool change counts, failure rates and mean change times from
+the journal written with [toolchanger] journal_path, including the rotated
+files:
+  python3 scripts/toolchange_journal.py ~/printer_data/logs/toolchange.journal
+"""
+import argparse, datetime, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'klipper', 'extras'))
+import tool_journal
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('journal', help="journal file path")
+    parser.add_argument('--days', type=float, default=None,
+                        help="only include the last N days")
+    parser.add_argument('--phases', action='store_true',
+                        help="also print the mean time per phase")
+    args = parser.parse_args()
+    records = tool_journal.read_journal(os.path.expanduser(args.journal))
+    if args.days is not None:
+        since = (datetime.datetime.now()
+                 - datetime.timedelta(days=args.days)).timestamp()
+        records = (r for r in records if r.get('t', 0.) >= since)
+    tools = tool_journal.summarize(records)
+    print("%-20s %8s %8s %8s %8s %8s %8s %10s" % (
+        'tool', 'changes', 'failed', 'verify', 'retries', 'errors', 'rate',
+        'mean_s'))
+    for name in sorted(tools):
+        summary = tools[name]
+        print("%-20s %8d %8d %8d %8d %8d %7.2f%% %10.3f" % (
+            name, summary.attempts, summary.failures,
+            summary.verify_failures, summary.retries, summary.errors,
+            summary.failure_rate() * 100., summary.mean_time()))
+        if args.phases and summary.changes:
+            for phase, total in summary.phase_time.items():
+                if phase != 'total':
+                    print("    %-16s %10.3f" % (
+                        phase, total / summary.changes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+# Load the toolchanger modules from this repo on top of a Klipper checkout
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import importlib, os, sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_KLIPPER_PATH = os.environ.get('KLIPPER_PATH', '~/klipper')
+
+def setup_extras_package(klipper_path):
+    """Make the klippy extras package importable, preferring the modules
+    in this repo over the installed symlinks."""
+    klippy_path = os.path.join(os.path.expanduser(klipper_path), 'klippy')
+    if klippy_path not in sys.path:
+        sys.path.insert(0, klippy_path)
+    import extras
+    repo_extras = os.path.join(REPO_DIR, 'klipper', 'extras')
+    if repo_extras not in extras.__path__:
+        extras.__path__.insert(0, repo_extras)
+    return extras
+
+def load_extras_module(klipper_path, name):
+    """Import klippy extras module, preferring the version in this repo."""
+    setup_extras_package(klipper_path)
+    return importlib.import_module('extras.' + name)
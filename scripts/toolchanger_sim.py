@@ -0,0 +1,1365 @@
+#!/usr/bin/env python3
+# Offline tool change simulator
+#
+# Copyright (C) 2026 Viesturs Zarins <viesturz@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+"""Runs the toolchanger modules from this repo against a fake printer.
+
+The reactor, gcode, gcode_move, toolhead, configfile and the other printer
+objects are simulated with a virtual clock, the tool detection pins follow
+the pickup and dropoff gcode. Reports the motion time, host time and CPU
+time for each command of a scripted sequence:
+  python3 scripts/toolchanger_sim.py scripts/sim/printer.cfg scripts/sim/changes.gcode --start-tool "tool T0"
+
+Besides gcode, the script may contain simulator directives:
+  !fail_pickup <tool section>  - next pickup of the tool is not detected
+  !late_pickup <tool section>  - next pickup of the tool is detected only
+                                 after the pickup gcode, not by path verifies
+  !detach <tool section>       - tool detection pin goes to docked
+  !attach <tool section>       - tool detection pin goes to mounted
+  !printing on|off             - virtual_sdcard print state
+  !wait <seconds>              - advance the clock
+
+Klipper is not needed, the few klippy modules imported by the toolchanger
+modules are replaced with stand-ins, unless --klipper is given.
+"""
+import argparse, ast, configparser, importlib, logging, math
+import os, re, shlex, sys, time, types
+import toolchanger_env
+
+EXTRAS_DIR = os.path.join(toolchanger_env.REPO_DIR, 'klipper', 'extras')
+
+######################################################################
+# Errors
+######################################################################
+
+class ConfigError(Exception):
+    pass
+
+class CommandError(Exception):
+    pass
+
+######################################################################
+# Reactor with a virtual clock
+######################################################################
+
+class FakeTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+class FakeCompletion:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = None
+        self.done = False
+    def test(self):
+        return self.done
+    def complete(self, result):
+        self.done = True
+        self.result = result
+    def wait(self, waketime=None, waketime_result=None):
+        if waketime is None:
+            waketime = self.reactor.NEVER
+        self.reactor._run_until(waketime, lambda: self.done)
+        if not self.done:
+            return waketime_result
+        return self.result
+
+class FakeReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+    def __init__(self):
+        self.now = 1.
+        self.timers = []
+    def monotonic(self):
+        return self.now
+    def register_timer(self, callback, waketime=NEVER):
+        timer = FakeTimer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+    def unregister_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+    def register_callback(self, callback, waketime=NOW):
+        def _once(eventtime):
+            self.unregister_timer(timer)
+            callback(eventtime)
+            return self.NEVER
+        timer = self.register_timer(_once, waketime)
+        return timer
+    def completion(self):
+        return FakeCompletion(self)
+    def pause(self, waketime):
+        self._run_until(waketime)
+        return self.now
+    def _run_until(self, waketime, done=None):
+        while done is None or not done():
+            pending = [t for t in self.timers if t.waketime <= waketime]
+            if not pending:
+                break
+            timer = min(pending, key=lambda t: t.waketime)
+            self.now = max(self.now, timer.waketime)
+            timer.waketime = timer.callback(self.now)
+            if timer.waketime is None:
+                timer.waketime = self.NEVER
+        if (done is None or not done()) and waketime < self.NEVER:
+            self.now = max(self.now, waketime)
+    def run_pending(self):
+        self._run_until(self.now)
+
+######################################################################
+# Config
+######################################################################
+
+# Marks a required option or parameter.
+_sentinel = object()
+
+class FakeConfig:
+    error = ConfigError
+    def __init__(self, printer, fileconfig, section):
+        self.printer = printer
+        self.fileconfig = fileconfig
+        self.section = section
+    def get_printer(self):
+        return self.printer
+    def get_name(self):
+        return self.section
+    def _get(self, parser, option, default, minval=None, maxval=None,
+             above=None, below=None):
+        if not self.fileconfig.has_option(self.section, option):
+            if default is _sentinel:
+                raise self.error("Option '%s' in section '%s' must be specified"
+                                 % (option, self.section))
+            return default
+        value = self.fileconfig.get(self.section, option)
+        try:
+            value = parser(value)
+        except ValueError:
+            raise self.error("Unable to parse option '%s' in section '%s'"
+                             % (option, self.section))
+        if minval is not None and value < minval:
+            raise self.error("Option '%s' in section '%s' must have minimum of %s"
+                             % (option, self.section, minval))
+        if maxval is not None and value > maxval:
+            raise self.error("Option '%s' in section '%s' must have maximum of %s"
+                             % (option, self.section, maxval))
+        if above is not None and value <= above:
+            raise self.error("Option '%s' in section '%s' must be above %s"
+                             % (option, self.section, above))
+        if below is not None and value >= below:
+            raise self.error("Option '%s' in section '%s' must be below %s"
+                             % (option, self.section, below))
+        return value
+    def get(self, option, default=_sentinel, **kw):
+        return self._get(str, option, default, **kw)
+    def getint(self, option, default=_sentinel, minval=None, maxval=None):
+        return self._get(int, option, default, minval, maxval)
+    def getfloat(self, option, default=_sentinel, minval=None, maxval=None,
+                 above=None, below=None):
+        return self._get(float, option, default, minval, maxval, above, below)
+    def getboolean(self, option, default=_sentinel):
+        def parse(v):
+            v = v.strip().lower()
+            if v in ('1', 'true', 'yes', 'on'):
+                return True
+            if v in ('0', 'false', 'no', 'off'):
+                return False
+            raise ValueError(v)
+        return self._get(parse, option, default)
+    def getchoice(self, option, choices, default=_sentinel):
+        value = self.get(option, default)
+        if value not in choices:
+            raise self.error("Choice '%s' for option '%s' in section '%s'"
+                             " is not a valid choice" % (value, option,
+                                                         self.section))
+        return choices[value]
+    def getlist(self, option, default=None, sep=','):
+        value = self.get(option, None)
+        if value is None:
+            return default
+        return [v.strip() for v in value.split(sep) if v.strip()]
+    def get_prefix_options(self, prefix):
+        return [o for o in self.fileconfig.options(self.section)
+                if o.startswith(prefix)]
+    def get_prefix_sections(self, prefix):
+        return [self.getsection(s) for s in self.fileconfig.sections()
+                if s.startswith(prefix)]
+    def has_section(self, section):
+        return self.fileconfig.has_section(section)
+    def getsection(self, section):
+        return FakeConfig(self.printer, self.fileconfig, section)
+
+def read_config_file(path, fileconfig=None):
+    if fileconfig is None:
+        fileconfig = configparser.RawConfigParser(
+            strict=False, inline_comment_prefixes=(';', '#'),
+            delimiters=(':', '='), interpolation=None)
+    data = open(path).read()
+    # Strip the SAVE_CONFIG block and handle includes section by section.
+    data = data.split('#*# <---------------------- SAVE_CONFIG')[0]
+    chunks = re.split(r'^\[include ([^\]]+)\]\s*$', data, flags=re.M)
+    fileconfig.read_string(chunks[0], path)
+    for i in range(1, len(chunks), 2):
+        include = os.path.join(os.path.dirname(path), chunks[i].strip())
+        read_config_file(include, fileconfig)
+        fileconfig.read_string(chunks[i + 1], path)
+    return fileconfig
+
+######################################################################
+# Gcode dispatch
+######################################################################
+
+class FakeGCodeCommand:
+    error = CommandError
+    def __init__(self, gcode, command, commandline, params):
+        self._gcode = gcode
+        self._command = command
+        self._commandline = commandline
+        self._params = params
+        self.respond_info = gcode.respond_info
+        self.respond_raw = gcode.respond_raw
+    def get_command(self):
+        return self._command
+    def get_commandline(self):
+        return self._commandline
+    def get_command_parameters(self):
+        return self._params
+    def get_raw_command_parameters(self):
+        parts = self._commandline.split(None, 1)
+        return parts[1] if len(parts) > 1 else ""
+    def _get(self, name, default, parser, minval=None, maxval=None,
+             above=None, below=None):
+        value = self._params.get(name)
+        if value is None:
+            if default is _sentinel:
+                raise self.error("Error on '%s': missing %s"
+                                 % (self._commandline, name))
+            return default
+        try:
+            value = parser(value)
+        except Exception:
+            raise self.error("Error on '%s': unable to parse %s"
+                             % (self._commandline, value))
+        if minval is not None and value < minval:
+            raise self.error("Error on '%s': %s must have minimum of %s"
+                             % (self._commandline, name, minval))
+        if maxval is not None and value > maxval:
+            raise self.error("Error on '%s': %s must have maximum of %s"
+                             % (self._commandline, name, maxval))
+        if above is not None and value <= above:
+            raise self.error("Error on '%s': %s must be above %s"
+                             % (self._commandline, name, above))
+        if below is not None and value >= below:
+            raise self.error("Error on '%s': %s must be below %s"
+                             % (self._commandline, name, below))
+        return value
+    def get(self, name, default=_sentinel, parser=str, minval=None,
+            maxval=None, above=None, below=None):
+        return self._get(name, default, parser, minval, maxval, above, below)
+    def get_int(self, name, default=_sentinel, minval=None, maxval=None):
+        return self._get(name, default, int, minval, maxval)
+    def get_float(self, name, default=_sentinel, minval=None, maxval=None,
+                  above=None, below=None):
+        return self._get(name, default, float, minval, maxval, above, below)
+
+class FakeGCode:
+    error = CommandError
+    args_r = re.compile('([A-Z_]+|[A-Z*])')
+    extended_r = re.compile(
+        r'^\s*(?:N[0-9]+\s*)?'
+        r'(?P<cmd>[a-zA-Z_][a-zA-Z0-9_]+)(?:\s+|$)'
+        r'(?P<args>[^#*;]*?)'
+        r'\s*(?:[#*;].*)?$')
+    def __init__(self, printer):
+        self.printer = printer
+        self.handlers = {}
+        self.mux_commands = {}
+        self.responses = []
+        self.commands = []
+        self.unknown = []
+    def _is_traditional(self, cmd):
+        return re.match(r'^[A-Z]\d+(\.\d+)?$', cmd) is not None
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        if func is None:
+            return self.handlers.pop(cmd, None)
+        if cmd in self.handlers:
+            raise self.printer.config_error(
+                "gcode command %s already registered" % (cmd,))
+        if not self._is_traditional(cmd):
+            origfunc = func
+            func = lambda gcmd: origfunc(self._get_extended_params(gcmd))
+            func.origfunc = origfunc
+        self.handlers[cmd] = func
+        return None
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        prev = self.mux_commands.get(cmd)
+        if prev is None:
+            handler = lambda gcmd: self._cmd_mux(cmd, gcmd)
+            self.register_command(cmd, handler, desc=desc)
+            self.mux_commands[cmd] = prev = (key, {})
+        if prev[0] != key:
+            raise self.printer.config_error(
+                "mux command %s %s %s may have only one key (%s)"
+                % (cmd, key, value, prev[0]))
+        if value in prev[1]:
+            raise self.printer.config_error(
+                "mux command %s %s %s already registered"
+                % (cmd, key, value))
+        prev[1][value] = func
+    def _cmd_mux(self, command, gcmd):
+        key, values = self.mux_commands[command]
+        if None in values:
+            key_param = gcmd.get(key, None)
+        else:
+            key_param = gcmd.get(key)
+        if key_param not in values:
+            raise gcmd.error("The value '%s' is not valid for %s"
+                             % (key_param, key))
+        values[key_param](gcmd)
+    def _get_extended_params(self, gcmd):
+        m = self.extended_r.match(gcmd.get_commandline())
+        if m is None:
+            raise self.error("Malformed command '%s'"
+                             % (gcmd.get_commandline(),))
+        eargs = m.group('args')
+        eparams = [earg.split('=', 1) for earg in shlex.split(eargs)]
+        gcmd._params.clear()
+        gcmd._params.update({k.upper(): v for k, v in eparams})
+        return gcmd
+    def create_gcode_command(self, command, commandline, params):
+        return FakeGCodeCommand(self, command, commandline, params)
+    def respond_info(self, msg, log=True):
+        self.responses.append(msg)
+    def respond_raw(self, msg):
+        self.responses.append(msg)
+    def run_script_from_command(self, script):
+        for line in script.split('\n'):
+            self._process_line(line)
+    run_script = run_script_from_command
+    def _process_line(self, origline):
+        line = origline.strip()
+        cpos = line.find(';')
+        if cpos >= 0:
+            line = line[:cpos]
+        if not line or line.startswith('#'):
+            return
+        parts = self.args_r.split(line.upper())
+        numparts = len(parts)
+        cmd = ""
+        if numparts >= 3 and parts[1] != 'N':
+            cmd = parts[1] + parts[2].strip()
+        elif numparts >= 5 and parts[1] == 'N':
+            cmd = parts[3] + parts[4].strip()
+        params = {parts[i]: parts[i + 1].strip()
+                  for i in range(1, numparts, 2)}
+        gcmd = FakeGCodeCommand(self, cmd, line, params)
+        self.commands.append(line)
+        handler = self.handlers.get(cmd)
+        if handler is None:
+            self.unknown.append(line)
+            return
+        handler(gcmd)
+
+######################################################################
+# gcode_macro (jinja templates and [gcode_macro] sections)
+######################################################################
+
+class StatusWrapper:
+    def __init__(self, printer, eventtime):
+        self.printer = printer
+        self.eventtime = eventtime
+        self.cache = {}
+    def __getitem__(self, name):
+        if name in self.cache:
+            return self.cache[name]
+        obj = self.printer.lookup_object(name, None)
+        if obj is None or not hasattr(obj, 'get_status'):
+            raise KeyError(name)
+        self.cache[name] = res = obj.get_status(self.eventtime)
+        return res
+    def __contains__(self, name):
+        try:
+            self.__getitem__(name)
+        except KeyError:
+            return False
+        return True
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class FakeTemplateWrapper:
+    def __init__(self, printer, env, name, script):
+        self.printer = printer
+        self.name = name
+        self.gcode = printer.lookup_object('gcode')
+        self.create_template_context = \
+            printer.lookup_object('gcode_macro').create_template_context
+        self.template = env.from_string(script)
+    def render(self, context=None):
+        if context is None:
+            context = self.create_template_context()
+        return str(self.template.render(context))
+    def run_gcode_from_command(self, context=None):
+        self.gcode.run_script_from_command(self.render(context))
+
+class FakeGCodeMacroModule:
+    def __init__(self, printer):
+        import jinja2
+        self.printer = printer
+        self.env = jinja2.Environment('{%', '%}', '{', '}',
+                                      extensions=['jinja2.ext.do'])
+    def load_template(self, config, option, default=None):
+        name = "%s:%s" % (config.get_name(), option)
+        if default is None:
+            script = config.get(option)
+        else:
+            script = config.get(option, default)
+        return FakeTemplateWrapper(self.printer, self.env, name, script)
+    def _action_respond_info(self, msg):
+        self.printer.lookup_object('gcode').respond_info(msg)
+        return ""
+    def _action_raise_error(self, msg):
+        raise self.printer.command_error(msg)
+    def create_template_context(self, eventtime=None):
+        if eventtime is None:
+            eventtime = self.printer.get_reactor().monotonic()
+        return {
+            'printer': StatusWrapper(self.printer, eventtime),
+            'action_respond_info': self._action_respond_info,
+            'action_raise_error': self._action_raise_error,
+        }
+
+class FakeGCodeMacro:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.alias = config.get_name().split()[-1].upper()
+        gcode_macro = self.printer.lookup_object('gcode_macro')
+        self.template = gcode_macro.load_template(config, 'gcode')
+        self.gcode = self.printer.lookup_object('gcode')
+        self.rename_existing = config.get('rename_existing', None)
+        self.variables = {}
+        for option in config.get_prefix_options('variable_'):
+            self.variables[option[9:]] = ast.literal_eval(config.get(option))
+        if self.rename_existing is not None:
+            self.printer.register_event_handler('klippy:connect',
+                                                self._handle_connect)
+        else:
+            self.gcode.register_command(self.alias, self.cmd)
+        self.gcode.register_mux_command('SET_GCODE_VARIABLE', 'MACRO',
+                                        config.get_name().split()[-1],
+                                        self.cmd_SET_GCODE_VARIABLE)
+    def _handle_connect(self):
+        prev = self.gcode.register_command(self.alias, None)
+        if prev is not None:
+            self.gcode.register_command(self.rename_existing.upper(),
+                                        getattr(prev, 'origfunc', prev))
+        self.gcode.register_command(self.alias, self.cmd)
+    def get_status(self, eventtime):
+        return self.variables
+    def cmd_SET_GCODE_VARIABLE(self, gcmd):
+        variable = gcmd.get('VARIABLE')
+        value = gcmd.get('VALUE')
+        self.variables = dict(self.variables)
+        self.variables[variable] = ast.literal_eval(value)
+    def cmd(self, gcmd):
+        kwparams = dict(self.template.create_template_context())
+        kwparams.update(self.variables)
+        kwparams['params'] = gcmd.get_command_parameters()
+        kwparams['rawparams'] = gcmd.get_raw_command_parameters()
+        self.template.run_gcode_from_command(kwparams)
+
+######################################################################
+# Motion: toolhead and gcode_move
+######################################################################
+
+class FakeMCU:
+    def __init__(self, reactor):
+        self.reactor = reactor
+    def estimated_print_time(self, eventtime):
+        return eventtime
+
+class FakeKinematics:
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
+    def get_status(self, eventtime):
+        return {'homed_axes': self.toolhead.homed_axes}
+
+class FakeToolhead:
+    BUFFER_TIME = 0.250
+    def __init__(self, printer, config):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.mcu = FakeMCU(self.reactor)
+        section = config.getsection('printer')
+        if not config.has_section('printer'):
+            section = None
+        def opt(name, default):
+            if section is None:
+                return default
+            return section.getfloat(name, default)
+        self.max_velocity = opt('max_velocity', 500.)
+        self.max_accel = opt('max_accel', 10000.)
+        self.square_corner_velocity = opt('square_corner_velocity', 5.)
+        self.min_cruise_ratio = opt('minimum_cruise_ratio', .5)
+        self.commanded_pos = [0., 0., 0., 0.]
+        self.print_time = 0.
+        self.homed_axes = 'xyz'
+        self.extruder = DummyExtruder()
+        self.kin = FakeKinematics(self)
+        self.moves = []
+        self.flushes = 0
+        self.lookahead_callbacks = []
+        self.move_transform_calls = 0
+    # Timing helpers
+    def _calc_print_time(self):
+        est = self.mcu.estimated_print_time(self.reactor.monotonic())
+        if self.print_time < est + self.BUFFER_TIME:
+            self.print_time = est + self.BUFFER_TIME
+    def _move_time(self, dist, speed):
+        speed = min(speed, self.max_velocity)
+        if dist <= 0. or speed <= 0.:
+            return 0.
+        accel = self.max_accel
+        accel_d = speed * speed / accel
+        if dist < accel_d:
+            return 2. * math.sqrt(dist / accel)
+        return 2. * speed / accel + (dist - accel_d) / speed
+    # Toolhead API
+    def get_position(self):
+        return list(self.commanded_pos)
+    def set_position(self, newpos, homing_axes=()):
+        self.flush_step_generation()
+        self.commanded_pos[:] = newpos
+    def move(self, newpos, speed):
+        self._calc_print_time()
+        dist = math.sqrt(sum((newpos[i] - self.commanded_pos[i]) ** 2
+                             for i in range(3)))
+        if not dist:
+            dist = abs(newpos[3] - self.commanded_pos[3])
+        duration = self._move_time(dist, speed)
+        self.moves.append((self.print_time, tuple(newpos), speed))
+        self.print_time += duration
+        if newpos[3] != self.commanded_pos[3]:
+            self.extruder.last_position = newpos[3]
+        self.commanded_pos[:] = newpos
+    def manual_move(self, coord, speed):
+        curpos = list(self.commanded_pos)
+        for i in range(len(coord)):
+            if coord[i] is not None:
+                curpos[i] = coord[i]
+        self.move(curpos, speed)
+    def dwell(self, delay):
+        self._calc_print_time()
+        self.print_time += max(0., delay)
+    def get_last_move_time(self):
+        self.flush_step_generation()
+        self._calc_print_time()
+        return self.print_time
+    def flush_step_generation(self):
+        self.flushes += 1
+    def wait_moves(self):
+        self.flush_step_generation()
+        self.reactor.pause(self.print_time)
+    def register_lookahead_callback(self, callback):
+        self._calc_print_time()
+        callback(self.print_time)
+    def get_kinematics(self):
+        return self.kin
+    def get_extruder(self):
+        return self.extruder
+    def set_extruder(self, extruder, extrude_pos):
+        self.extruder = extruder
+        self.commanded_pos[3] = extrude_pos
+    def get_status(self, eventtime):
+        return {'position': list(self.commanded_pos),
+                'homed_axes': self.homed_axes,
+                'extruder': self.extruder.get_name(),
+                'max_velocity': self.max_velocity,
+                'max_accel': self.max_accel,
+                'square_corner_velocity': self.square_corner_velocity,
+                'minimum_cruise_ratio': self.min_cruise_ratio}
+    def set_max_velocities(self, max_velocity, max_accel,
+                           square_corner_velocity, min_cruise_ratio):
+        if max_velocity is not None:
+            self.max_velocity = max_velocity
+        if max_accel is not None:
+            self.max_accel = max_accel
+        if square_corner_velocity is not None:
+            self.square_corner_velocity = square_corner_velocity
+        if min_cruise_ratio is not None:
+            self.min_cruise_ratio = min_cruise_ratio
+        return (self.max_velocity, self.max_accel,
+                self.square_corner_velocity, self.min_cruise_ratio)
+
+class FakeGCodeMove:
+    def __init__(self, printer):
+        self.printer = printer
+        self.absolute_coord = self.absolute_extrude = True
+        self.base_position = [0.0, 0.0, 0.0, 0.0]
+        self.last_position = [0.0, 0.0, 0.0, 0.0]
+        self.homing_position = [0.0, 0.0, 0.0, 0.0]
+        self.speed = 25.
+        self.speed_factor = 1. / 60.
+        self.extrude_factor = 1.
+        self.saved_states = {}
+        self.move_transform = self.move_with_transform = None
+        self.position_with_transform = (lambda: [0., 0., 0., 0.])
+        self.moves = 0
+        gcode = printer.lookup_object('gcode')
+        for cmd in ['G1', 'G0', 'G90', 'G91', 'G92', 'M82', 'M83',
+                    'SAVE_GCODE_STATE', 'RESTORE_GCODE_STATE',
+                    'SET_GCODE_OFFSET']:
+            func = getattr(self, 'cmd_' + cmd.replace('G0', 'G1'))
+            gcode.register_command(cmd, func)
+        printer.register_event_handler('extruder:activate_extruder',
+                                       self._handle_activate_extruder)
+    def _handle_ready(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        if self.move_transform is None:
+            self.move_with_transform = toolhead.move
+            self.position_with_transform = toolhead.get_position
+        self.reset_last_position()
+    def _handle_activate_extruder(self):
+        self.reset_last_position()
+        self.extrude_factor = 1.
+        self.base_position[3] = self.last_position[3]
+    def set_move_transform(self, transform, force=False):
+        if self.move_transform is not None and not force:
+            raise self.printer.config_error(
+                "G-Code move transform already specified")
+        old_transform = self.move_transform
+        if old_transform is None:
+            old_transform = self.printer.lookup_object('toolhead', None)
+        self.move_transform = transform
+        self.move_with_transform = transform.move
+        self.position_with_transform = transform.get_position
+        return old_transform
+    def _get_gcode_position(self):
+        p = [lp - bp for lp, bp in zip(self.last_position,
+                                       self.base_position)]
+        p[3] /= self.extrude_factor
+        return p
+    def _get_gcode_speed(self):
+        return self.speed / self.speed_factor
+    def get_status(self, eventtime=None):
+        return {
+            'speed_factor': self.speed_factor * 60.,
+            'speed': self._get_gcode_speed(),
+            'extrude_factor': self.extrude_factor,
+            'absolute_coordinates': self.absolute_coord,
+            'absolute_extrude': self.absolute_extrude,
+            'homing_origin': list(self.homing_position),
+            'position': list(self.last_position),
+            'gcode_position': self._get_gcode_position(),
+        }
+    def reset_last_position(self):
+        self.last_position = self.position_with_transform()
+    def cmd_G1(self, gcmd):
+        params = gcmd.get_command_parameters()
+        for pos, axis in enumerate('XYZ'):
+            if axis in params:
+                v = float(params[axis])
+                if not self.absolute_coord:
+                    self.last_position[pos] += v
+                else:
+                    self.last_position[pos] = v + self.base_position[pos]
+        if 'E' in params:
+            v = float(params['E']) * self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                self.last_position[3] += v
+            else:
+                self.last_position[3] = v + self.base_position[3]
+        if 'F' in params:
+            gcode_speed = float(params['F'])
+            if gcode_speed <= 0.:
+                raise gcmd.error("Invalid speed in '%s'"
+                                 % (gcmd.get_commandline(),))
+            self.speed = gcode_speed * self.speed_factor
+        self.moves += 1
+        self.move_with_transform(self.last_position, self.speed)
+    def cmd_G90(self, gcmd):
+        self.absolute_coord = True
+    def cmd_G91(self, gcmd):
+        self.absolute_coord = False
+    def cmd_M82(self, gcmd):
+        self.absolute_extrude = True
+    def cmd_M83(self, gcmd):
+        self.absolute_extrude = False
+    def cmd_G92(self, gcmd):
+        offsets = [gcmd.get_float(a, None) for a in 'XYZE']
+        for i, offset in enumerate(offsets):
+            if offset is not None:
+                if i == 3:
+                    offset *= self.extrude_factor
+                self.base_position[i] = self.last_position[i] - offset
+        if offsets == [None, None, None, None]:
+            self.base_position = list(self.last_position)
+    def cmd_SET_GCODE_OFFSET(self, gcmd):
+        move_delta = [0., 0., 0., 0.]
+        for pos, axis in enumerate('XYZE'):
+            offset = gcmd.get_float(axis, None)
+            if offset is None:
+                offset = gcmd.get_float(axis + '_ADJUST', None)
+                if offset is None:
+                    continue
+                offset += self.homing_position[pos]
+            delta = offset - self.homing_position[pos]
+            move_delta[pos] = delta
+            self.base_position[pos] += delta
+            self.homing_position[pos] = offset
+        if gcmd.get_int('MOVE', 0):
+            speed = gcmd.get_float('MOVE_SPEED', self.speed, above=0.)
+            for pos, delta in enumerate(move_delta):
+                self.last_position[pos] += delta
+            self.move_with_transform(self.last_position, speed)
+    def cmd_SAVE_GCODE_STATE(self, gcmd):
+        state_name = gcmd.get('NAME', 'default')
+        self.saved_states[state_name] = {
+            'absolute_coord': self.absolute_coord,
+            'absolute_extrude': self.absolute_extrude,
+            'base_position': list(self.base_position),
+            'last_position': list(self.last_position),
+            'homing_position': list(self.homing_position),
+            'speed': self.speed, 'speed_factor': self.speed_factor,
+            'extrude_factor': self.extrude_factor,
+        }
+    def cmd_RESTORE_GCODE_STATE(self, gcmd):
+        state_name = gcmd.get('NAME', 'default')
+        state = self.saved_states.get(state_name)
+        if state is None:
+            raise gcmd.error("Unknown g-code state: %s" % (state_name,))
+        self.absolute_coord = state['absolute_coord']
+        self.absolute_extrude = state['absolute_extrude']
+        self.base_position = list(state['base_position'])
+        self.homing_position = list(state['homing_position'])
+        self.speed = state['speed']
+        self.speed_factor = state['speed_factor']
+        self.extrude_factor = state['extrude_factor']
+        e_diff = self.last_position[3] - state['last_position'][3]
+        self.base_position[3] += e_diff
+        if gcmd.get_int('MOVE', 0):
+            speed = gcmd.get_float('MOVE_SPEED', self.speed, above=0.)
+            self.last_position[:3] = state['last_position'][:3]
+            self.move_with_transform(self.last_position, speed)
+
+######################################################################
+# Heaters, extruders, fans, buttons
+######################################################################
+
+class FakeHeater:
+    HEAT_RATE = 4.
+    def __init__(self, printer, name):
+        self.printer = printer
+        self.name = name
+        self.target = 0.
+        self.temperature = 25.
+        self.last_update = printer.get_reactor().monotonic()
+    def _update(self, eventtime):
+        dt = max(0., eventtime - self.last_update)
+        self.last_update = eventtime
+        step = self.HEAT_RATE * dt
+        goal = max(self.target, 25.)
+        if self.temperature < goal:
+            self.temperature = min(goal, self.temperature + step)
+        else:
+            self.temperature = max(goal, self.temperature - step)
+    def set_temp(self, degrees):
+        self._update(self.printer.get_reactor().monotonic())
+        self.target = degrees
+    def get_temp(self, eventtime):
+        self._update(eventtime)
+        return self.temperature, self.target
+    def check_busy(self, eventtime):
+        self._update(eventtime)
+        return abs(self.temperature - self.target) > 1. and self.target > 0.
+    def get_status(self, eventtime):
+        self._update(eventtime)
+        return {'temperature': self.temperature, 'target': self.target,
+                'power': 0.}
+
+class FakeHeaters:
+    def __init__(self, printer):
+        self.printer = printer
+        self.heaters = {}
+        self.set_calls = []
+    def lookup_heater(self, name):
+        if name not in self.heaters:
+            self.heaters[name] = FakeHeater(self.printer, name)
+        return self.heaters[name]
+    def set_temperature(self, heater, temp, wait=False):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(lambda pt: None)
+        self.set_calls.append((heater.name, temp, wait))
+        heater.set_temp(temp)
+        if wait and temp:
+            reactor = self.printer.get_reactor()
+            while heater.check_busy(reactor.monotonic()):
+                reactor.pause(reactor.monotonic() + 1.)
+
+class DummyExtruder:
+    def get_name(self):
+        return ''
+    name = ''
+    last_position = 0.
+
+class FakeExtruderStepper:
+    def __init__(self, printer, name):
+        self.printer = printer
+        self.name = name
+        self.motion_queue = None
+        self.sync_calls = 0
+        self.pressure_advance = 0.
+        self.smooth_time = 0.04
+    def sync_to_extruder(self, extruder_name):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.flush_step_generation()
+        self.sync_calls += 1
+        self.motion_queue = extruder_name or None
+    def cmd_SET_PRESSURE_ADVANCE(self, gcmd):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.flush_step_generation()
+        self.pressure_advance = gcmd.get_float('ADVANCE',
+                                               self.pressure_advance)
+        self.smooth_time = gcmd.get_float('SMOOTH_TIME', self.smooth_time)
+    def get_status(self, eventtime):
+        return {'motion_queue': self.motion_queue,
+                'pressure_advance': self.pressure_advance,
+                'smooth_time': self.smooth_time}
+
+class FakePrinterExtruderStepper:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.name = config.get_name().split()[-1]
+        self.extruder_stepper = FakeExtruderStepper(self.printer, self.name)
+        self.extruder_name = config.get('extruder', None)
+        if self.extruder_name:
+            self.printer.register_event_handler(
+                'klippy:connect', lambda: self.extruder_stepper
+                .sync_to_extruder(self.extruder_name))
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command('SYNC_EXTRUDER_MOTION', 'EXTRUDER',
+                                   self.name, self.cmd_SYNC_EXTRUDER_MOTION)
+    def cmd_SYNC_EXTRUDER_MOTION(self, gcmd):
+        self.extruder_stepper.sync_to_extruder(gcmd.get('MOTION_QUEUE'))
+    def get_status(self, eventtime):
+        return self.extruder_stepper.get_status(eventtime)
+
+class FakeExtruder:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.name = config.get_name()
+        self.last_position = 0.
+        self.heater = self.printer.lookup_object('heaters').lookup_heater(
+            self.name)
+        self.extruder_stepper = FakeExtruderStepper(self.printer, self.name)
+        self.extruder_stepper.motion_queue = self.name
+        self.extruder_stepper.pressure_advance = config.getfloat(
+            'pressure_advance', 0.)
+        self.extruder_stepper.smooth_time = config.getfloat(
+            'pressure_advance_smooth_time', 0.04)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command('ACTIVATE_EXTRUDER', 'EXTRUDER',
+                                   self.name, self.cmd_ACTIVATE_EXTRUDER)
+        gcode.register_mux_command('SYNC_EXTRUDER_MOTION', 'EXTRUDER',
+                                   self.name, self.cmd_SYNC_EXTRUDER_MOTION)
+        gcode.register_mux_command(
+            'SET_PRESSURE_ADVANCE', 'EXTRUDER', self.name,
+            self.extruder_stepper.cmd_SET_PRESSURE_ADVANCE)
+        if self.name == 'extruder':
+            self.printer.register_event_handler('klippy:connect',
+                                                self._activate_default)
+    def _activate_default(self):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.set_extruder(self, 0.)
+    def get_name(self):
+        return self.name
+    def get_heater(self):
+        return self.heater
+    def get_trapq(self):
+        return None
+    def cmd_ACTIVATE_EXTRUDER(self, gcmd):
+        toolhead = self.printer.lookup_object('toolhead')
+        if toolhead.get_extruder() is self:
+            gcmd.respond_info("Extruder %s already active" % (self.name,))
+            return
+        toolhead.flush_step_generation()
+        toolhead.set_extruder(self, self.last_position)
+        self.printer.send_event("extruder:activate_extruder")
+    def cmd_SYNC_EXTRUDER_MOTION(self, gcmd):
+        self.extruder_stepper.sync_to_extruder(gcmd.get('MOTION_QUEUE'))
+    def get_status(self, eventtime):
+        status = self.heater.get_status(eventtime)
+        status.update(self.extruder_stepper.get_status(eventtime))
+        status.update({'can_extrude': True})
+        return status
+
+class FakeFan:
+    def __init__(self, printer):
+        self.printer = printer
+        self.speed = 0.
+        self.requests = []
+    def set_speed(self, value, print_time=None):
+        self.requests.append((print_time, value))
+        self.speed = value
+    def set_speed_from_command(self, value):
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.register_lookahead_callback(
+            lambda pt: self.set_speed(value, print_time=pt))
+    def get_status(self, eventtime):
+        return {'speed': self.speed, 'rpm': None}
+
+class FakeFanGeneric:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.fan = FakeFan(self.printer)
+        self.fan_name = config.get_name().split()[-1]
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command('SET_FAN_SPEED', 'FAN', self.fan_name,
+                                   self.cmd_SET_FAN_SPEED)
+    def get_status(self, eventtime):
+        return self.fan.get_status(eventtime)
+    def cmd_SET_FAN_SPEED(self, gcmd):
+        self.fan.set_speed_from_command(gcmd.get_float('SPEED', 0.))
+
+class FakeButtons:
+    def __init__(self, printer):
+        self.printer = printer
+        self.callbacks = {}
+        self.states = {}
+    def register_buttons(self, pins, callback):
+        for pin in pins:
+            self.callbacks[pin.lstrip('^~!')] = callback
+    def set_state(self, pin, state, eventtime=None):
+        pin = pin.lstrip('^~!')
+        if self.states.get(pin) == state:
+            return
+        self.states[pin] = state
+        if eventtime is None:
+            eventtime = self.printer.get_reactor().monotonic()
+        self.callbacks[pin](eventtime, state)
+
+class FakeConfigfile:
+    def __init__(self, printer):
+        self.printer = printer
+        self.pending = {}
+    def set(self, section, option, value):
+        self.pending.setdefault(section, {})[option] = str(value)
+    def get_status(self, eventtime):
+        fileconfig = self.printer.fileconfig
+        config = {s: dict(fileconfig.items(s)) for s in fileconfig.sections()}
+        return {'config': config, 'settings': config,
+                'save_config_pending_items': self.pending}
+
+class FakeVirtualSD:
+    def __init__(self, printer):
+        self.printer = printer
+        self.current_file = None
+        self.file_position = 0
+        self.file_size = 0
+        self.active = False
+        fileconfig = printer.fileconfig
+        path = '.'
+        if fileconfig.has_option('virtual_sdcard', 'path'):
+            path = fileconfig.get('virtual_sdcard', 'path')
+        self.sdcard_dirname = os.path.normpath(os.path.expanduser(path))
+    def is_active(self):
+        return self.active
+    def file_path(self):
+        if self.current_file is None:
+            return None
+        return self.current_file.name
+    def get_status(self, eventtime):
+        return {'file_path': self.file_path(),
+                'file_position': self.file_position,
+                'file_size': self.file_size,
+                'is_active': self.active, 'progress': 0.}
+
+class FakeInputShaperParams:
+    # Same fields as klippy input_shaper.InputShaperParams
+    def __init__(self, axis, config):
+        self.axis = axis
+        shaper_type = config.get('shaper_type', 'mzv')
+        self.shaper_type = config.get('shaper_type_' + axis, shaper_type)
+        self.damping_ratio = config.getfloat('damping_ratio_' + axis, 0.1)
+        self.shaper_freq = config.getfloat('shaper_freq_' + axis, 0.)
+    def update(self, gcmd):
+        axis = self.axis.upper()
+        self.damping_ratio = gcmd.get_float('DAMPING_RATIO_' + axis,
+                                            self.damping_ratio)
+        self.shaper_freq = gcmd.get_float('SHAPER_FREQ_' + axis,
+                                          self.shaper_freq)
+        self.shaper_type = gcmd.get('SHAPER_TYPE_' + axis,
+                                    self.shaper_type).lower()
+
+class FakeAxisInputShaper:
+    def __init__(self, axis, config):
+        self.axis = axis
+        self.params = FakeInputShaperParams(axis, config)
+
+class FakeInputShaper:
+    def __init__(self, printer, config):
+        self.printer = printer
+        self.shapers = [FakeAxisInputShaper('x', config),
+                        FakeAxisInputShaper('y', config)]
+        self.updates = 0
+        printer.lookup_object('gcode').register_command(
+            'SET_INPUT_SHAPER', self.cmd_SET_INPUT_SHAPER)
+    def cmd_SET_INPUT_SHAPER(self, gcmd):
+        self.printer.lookup_object('toolhead').flush_step_generation()
+        for shaper in self.shapers:
+            shaper.params.update(gcmd)
+        self.updates += 1
+
+class FakeServo:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command('SET_SERVO', 'SERVO',
+                                   config.get_name().split()[-1],
+                                   lambda gcmd: None)
+
+class FakeIgnored:
+    def __init__(self, config=None):
+        pass
+    def get_status(self, eventtime):
+        return {}
+
+def install_klippy_modules(klipper_path=None):
+    """Make the extras package importable, with the modules in this repo.
+
+    Without a Klipper checkout, the klippy modules imported by the repo
+    modules are replaced with stand-ins. They are only imported, the
+    printer objects are simulated."""
+    if 'extras' in sys.modules:
+        return
+    if klipper_path:
+        toolchanger_env.setup_extras_package(klipper_path)
+        return
+    extras = types.ModuleType('extras')
+    extras.__path__ = [EXTRAS_DIR]
+    sys.modules['extras'] = extras
+    probe = types.ModuleType('extras.probe')
+    for name in ['ProbeCommandHelper', 'HomingViaProbeHelper',
+                 'ProbeSessionHelper', 'ProbeOffsetsHelper',
+                 'ProbeParameterHelper', 'ProbeEndstopWrapper']:
+        setattr(probe, name, type(name, (), {
+            '__init__': lambda self, *a, **kw: None}))
+    sys.modules['extras.probe'] = probe
+    fan = types.ModuleType('extras.fan')
+    fan.Fan = lambda config, *a, **kw: FakeFan(config.get_printer())
+    sys.modules['extras.fan'] = fan
+    for name in ['force_move', 'gcode_macro']:
+        sys.modules['extras.' + name] = types.ModuleType('extras.' + name)
+    sys.modules['stepper'] = types.ModuleType('stepper')
+
+######################################################################
+# Printer
+######################################################################
+
+FAKE_SECTIONS = {
+    'extruder': FakeExtruder,
+    'extruder_stepper': FakePrinterExtruderStepper,
+    'fan_generic': FakeFanGeneric,
+    'gcode_macro': FakeGCodeMacro,
+    'servo': FakeServo,
+}
+IGNORED_SECTIONS = ['printer', 'mcu', 'stepper_', 'tmc', 'heater_fan',
+                    'force_move', 'bed_mesh', 'safe_z_home', 'idle_timeout',
+                    'save_variables', 'virtual_sdcard', 'input_shaper',
+                    'probe', 'tool_probe', 'tools_calibrate', 'manual_rail',
+                    'heater_bed', 'temperature_sensor', 'respond',
+                    'pause_resume', 'display_status', 'exclude_object',
+                    'board_pins', 'controller_fan', 'gcode_arcs']
+
+class FakePrinter:
+    config_error = ConfigError
+    command_error = CommandError
+    def __init__(self, config_path, klipper_path=None):
+        install_klippy_modules(klipper_path)
+        self.reactor = FakeReactor()
+        self.objects = {}
+        self.event_handlers = {}
+        self.start_args = {'config_file': os.path.abspath(config_path)}
+        self.fileconfig = read_config_file(config_path)
+        self.config = FakeConfig(self, self.fileconfig, 'printer')
+        self.objects['gcode'] = FakeGCode(self)
+        self.objects['gcode_macro'] = FakeGCodeMacroModule(self)
+        self.objects['heaters'] = FakeHeaters(self)
+        self.objects['buttons'] = FakeButtons(self)
+        self.objects['configfile'] = FakeConfigfile(self)
+        self.objects['virtual_sdcard'] = FakeVirtualSD(self)
+        self.objects['webhooks'] = FakeIgnored()
+        self.objects['toolhead'] = FakeToolhead(self, self.config)
+        self.objects['gcode_move'] = FakeGCodeMove(self)
+        self.objects['input_shaper'] = FakeInputShaper(
+            self, self.config.getsection('input_shaper'))
+        for section in self.fileconfig.sections():
+            self.load_object(self.config, section)
+        self.objects['gcode_move']._handle_ready()
+        self.send_event('klippy:connect')
+        self.send_event('klippy:ready')
+        self.reactor.run_pending()
+    # Printer API
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return self.start_args
+    def lookup_object(self, name, default=ConfigError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is ConfigError:
+            raise self.config_error("Unknown config object '%s'" % (name,))
+        return default
+    def lookup_objects(self, module=None):
+        if module is None:
+            return list(self.objects.items())
+        prefix = module + ' '
+        return [(k, v) for k, v in self.objects.items()
+                if k.startswith(prefix) or k == module]
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+    def send_event(self, event, *params):
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+    def load_object(self, config, section, default=ConfigError):
+        if section in self.objects:
+            return self.objects[section]
+        module_name = section.split()[0]
+        if any(module_name.startswith(p) for p in IGNORED_SECTIONS):
+            self.objects[section] = obj = FakeIgnored()
+            return obj
+        factory = FAKE_SECTIONS.get(module_name)
+        if factory is None and module_name.startswith('extruder'):
+            factory = FakeExtruder
+        section_config = FakeConfig(self, self.fileconfig, section)
+        if factory is not None:
+            obj = factory(section_config)
+        else:
+            path = os.path.join(EXTRAS_DIR, module_name + '.py')
+            if not os.path.exists(path):
+                self.objects[section] = obj = FakeIgnored()
+                return obj
+            mod = importlib.import_module('extras.' + module_name)
+            if section != module_name:
+                obj = mod.load_config_prefix(section_config)
+            else:
+                obj = mod.load_config(section_config)
+        self.objects[section] = obj
+        return obj
+
+######################################################################
+# Simulated dock: toggles detection pins when tools are moved
+######################################################################
+
+class SimulatedDock:
+    """Models the physical tool mounting by flipping detection pins at the
+    print time the pickup/dropoff gcode finishes."""
+    def __init__(self, printer, settle_time=0.03):
+        self.printer = printer
+        self.settle_time = settle_time
+        self.fail_pickups = {}
+        self.late_pickups = {}
+        self.buttons = printer.lookup_object('buttons')
+        self.toolchanger = printer.lookup_object('toolchanger')
+        self.tools = [obj for name, obj in printer.lookup_objects('tool')
+                      if name.startswith('tool ')]
+        self.pins = {}
+        fileconfig = printer.fileconfig
+        for tool in self.tools:
+            if fileconfig.has_option(tool.name, 'detection_pin'):
+                self.pins[tool] = fileconfig.get(tool.name, 'detection_pin')
+        # All docked at start
+        for tool, pin in self.pins.items():
+            self.buttons.set_state(pin, True)
+        self.pending = None
+        orig_run_gcode = self.toolchanger.run_gcode
+        def run_gcode(name, template, extra_context, **kwargs):
+            if name == 'tool.pickup_gcode':
+                tool_name = extra_context.get('pickup_tool')
+                late = self.late_pickups.get(tool_name, 0) > 0
+                if late:
+                    self.late_pickups[tool_name] -= 1
+                self.pending = (tool_name, False, late)
+            elif name == 'tool.dropoff_gcode':
+                self.pending = (extra_context.get('dropoff_tool'), True, False)
+            try:
+                orig_run_gcode(name, template, extra_context, **kwargs)
+            finally:
+                self._flush_pending()
+        self.toolchanger.run_gcode = run_gcode
+        # Tool gets attached by the time a verify is requested in the path,
+        # unless the pickup is late.
+        gcode = printer.lookup_object('gcode')
+        orig_verify = gcode.register_command('VERIFY_TOOL_DETECTED', None)
+        def verify(gcmd):
+            self._flush_pending(verify=True)
+            orig_verify(gcmd)
+        gcode.handlers['VERIFY_TOOL_DETECTED'] = verify
+        orig_wait = self.toolchanger.wait_detected_tool
+        def wait_detected_tool(gcmd, expected):
+            self._flush_pending(verify=True)
+            orig_wait(gcmd, expected)
+        self.toolchanger.wait_detected_tool = wait_detected_tool
+    def mount(self, tool):
+        if tool in self.pins:
+            self.buttons.set_state(self.pins[tool], False)
+    def _flush_pending(self, verify=False):
+        if self.pending is None or (verify and self.pending[2]):
+            return
+        tool_name, docked, late = self.pending
+        self.pending = None
+        tool = self.printer.lookup_object(tool_name, None) if tool_name \
+            else None
+        if tool not in self.pins:
+            return
+        if not docked and self.fail_pickups.get(tool.name, 0) > 0:
+            self.fail_pickups[tool.name] -= 1
+            return
+        toolhead = self.printer.lookup_object('toolhead')
+        reactor = self.printer.get_reactor()
+        pin = self.pins[tool]
+        when = toolhead.print_time + self.settle_time
+        reactor.register_callback(
+            lambda e: self.buttons.set_state(pin, docked), when)
+
+######################################################################
+# Scenario runner
+######################################################################
+
+class ChangeStats:
+    def __init__(self, command):
+        self.command = command
+        self.cpu = 0.
+        self.wall = 0.
+        self.motion = 0.
+        self.moves = []
+        self.commands = []
+        self.flushes = 0
+        self.error = None
+
+class Simulator:
+    def __init__(self, config_path, klipper_path=None, settle_time=0.03,
+                 start_tool=None):
+        self.printer = FakePrinter(config_path, klipper_path)
+        self.gcode = self.printer.lookup_object('gcode')
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.reactor = self.printer.get_reactor()
+        self.dock = SimulatedDock(self.printer, settle_time)
+        if start_tool:
+            self.dock.mount(self.printer.lookup_object(start_tool))
+        self.stats = []
+        self.last_error = None
+    def run(self, script):
+        for line in script.split('\n'):
+            line = line.strip()
+            if not line or line.startswith(';'):
+                continue
+            if line.startswith('!'):
+                stats = ChangeStats(line)
+                start_reactor = self.reactor.monotonic()
+                self.run_directive(line)
+                stats.wall = self.reactor.monotonic() - start_reactor
+                self.stats.append(stats)
+            else:
+                stats = self.run_command(line)
+            self._check_error(stats)
+    def _check_error(self, stats):
+        # Errors raised outside of commands, like a tool going missing.
+        toolchanger = self.printer.lookup_object('toolchanger')
+        error = (toolchanger.status, toolchanger.error_message)
+        if error != self.last_error:
+            self.last_error = error
+            if toolchanger.status == 'error' and stats.error is None:
+                stats.error = "toolchanger error: %s" % (error[1],)
+    def run_directive(self, line):
+        parts = line[1:].split(None, 1)
+        directive, arg = parts[0], parts[1] if len(parts) > 1 else ''
+        if directive == 'fail_pickup':
+            self.dock.fail_pickups[arg] = self.dock.fail_pickups.get(arg, 0) + 1
+        elif directive == 'late_pickup':
+            self.dock.late_pickups[arg] = self.dock.late_pickups.get(arg, 0) + 1
+        elif directive in ('detach', 'attach'):
+            tool = self.printer.lookup_object(arg)
+            self.dock.buttons.set_state(self.dock.pins[tool],
+                                        directive == 'detach')
+        elif directive == 'printing':
+            self.printer.lookup_object('virtual_sdcard').active = arg == 'on'
+        elif directive == 'wait':
+            self.reactor.pause(self.reactor.monotonic() + float(arg))
+        else:
+            raise ConfigError("Unknown directive '%s'" % (line,))
+    def run_command(self, line):
+        th = self.toolhead
+        stats = ChangeStats(line)
+        moves, flushes = len(th.moves), th.flushes
+        commands = len(self.gcode.commands)
+        th._calc_print_time()
+        start_print_time = th.print_time
+        start_reactor = self.reactor.monotonic()
+        cpu = time.process_time()
+        try:
+            self.gcode.run_script_from_command(line)
+        except CommandError as e:
+            stats.error = str(e)
+        stats.cpu = time.process_time() - cpu
+        self.reactor.run_pending()
+        stats.motion = th.print_time - start_print_time
+        stats.wall = self.reactor.monotonic() - start_reactor
+        stats.moves = th.moves[moves:]
+        stats.commands = self.gcode.commands[commands + 1:]
+        stats.flushes = th.flushes - flushes
+        self.stats.append(stats)
+        return stats
+    def report(self, trace=False, out=sys.stdout):
+        out.write("%-32s %8s %9s %9s %6s %6s %7s\n" % (
+            'command', 'cpu_ms', 'motion_s', 'host_s', 'moves', 'cmds',
+            'flushes'))
+        for s in self.stats:
+            out.write("%-32s %8.3f %9.3f %9.3f %6d %6d %7d\n" % (
+                s.command[:32], s.cpu * 1000., s.motion, s.wall,
+                len(s.moves), len(s.commands), s.flushes))
+            if trace:
+                for cmd in s.commands:
+                    out.write("    > %s\n" % (cmd,))
+                for print_time, pos, speed in s.moves:
+                    out.write("    move %.3f [%s] %.1f\n" % (
+                        print_time, ' '.join('%.3f' % v for v in pos), speed))
+            if s.error:
+                out.write("    ERROR %s\n" % (s.error,))
+        out.write("total: %d lines, %.3f s motion, %.3f ms cpu\n" % (
+                len(self.stats), sum(s.motion for s in self.stats),
+                sum(s.cpu for s in self.stats) * 1000.))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', help="printer config to load")
+    parser.add_argument('script', nargs='?',
+                        help="gcode script file, defaults to stdin")
+    parser.add_argument('--klipper', default=None,
+                        help="Klipper checkout path, for the real klippy modules")
+    parser.add_argument('--start-tool', default=None,
+                        help="tool section mounted at start, eg 'tool T0'")
+    parser.add_argument('--settle', type=float, default=0.03,
+                        help="detection pin settle time in seconds")
+    parser.add_argument('--trace', action='store_true',
+                        help="print the commands and moves of each line")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print the log")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else
+                        logging.WARNING)
+    sim = Simulator(args.config, args.klipper, args.settle, args.start_tool)
+    script = open(args.script).read() if args.script else sys.stdin.read()
+    sim.run(script)
+    sim.report(args.trace)
+
+if __name__ == '__main__':
+    main()